@@ -0,0 +1,236 @@
+"""webduino.mqtt 效能量測，結果以 JSON 輸出方便比較不同版本
+
+    python3 bench_mqtt.py [-n 1000] [-o result.json]
+    micropython bench_mqtt.py
+
+會在本機啟動 broker.py 的 broker 替身，量測:
+    publish_qos0   單一 client QoS 0 發布速率 (到訂閱端收齊為止)
+    publish_qos1   QoS 1 發布速率與 PUBACK 延遲
+    latency        發布到收到的端對端延遲 (逐筆 ping-pong)
+    fanout         多個訂閱者時的分送速率
+    subscribe      連線前先 MQTT.sub (萬用字元)，量測連線到 SUBACK 的時間與分派速率
+    pipeline       經由 MQTT.pub 佇列 / 背景發布任務的速率
+    execcmd        Board.execCmd 指令分派成本
+"""
+import compat
+import sys, time, json
+import uasyncio
+from broker import Broker
+from webduino.amqtt import AsyncMQTTClient
+
+PORT = 18830
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Counter:
+
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+        self.last = 0
+        self.done = uasyncio.Event()
+
+    def cb(self, topic, msg, retain):
+        self.count += 1
+        self.last = time.ticks_us()
+        if self.count >= self.target:
+            self.done.set()
+
+
+async def client(name, cb=None, topics=None):
+    c = AsyncMQTTClient(name, '127.0.0.1', PORT, keepalive=0)
+    if cb:
+        c.set_callback(cb)
+    await c.connect()
+    c.task = uasyncio.create_task(c.run())
+    if topics:
+        await c.subscribe(topics)
+    return c
+
+
+async def close(*clients):
+    for c in clients:
+        await c.disconnect()
+        try:
+            await c.task
+        except Exception:
+            pass
+
+
+async def bench_publish(n, qos):
+    counter = Counter(n)
+    sub = await client('sub', counter.cb, [('bench/q', qos)])
+    pub = await client('pub')
+    msg = b'x' * 32
+    start = time.ticks_us()
+    for i in range(n):
+        await pub.publish('bench/q', msg, qos=qos)
+    await uasyncio.wait_for(counter.done.wait(), 30)
+    us = time.ticks_diff(counter.last, start)
+    result = {'messages': n, 'ms': us // 1000, 'msg_per_s': n * 1000000 // max(us, 1)}
+    if qos:
+        st = pub.qos_stats
+        result['ack_ms_avg'] = st['ack_ms_total'] / max(st['acked'], 1)
+        result['ack_ms_max'] = st['ack_ms_max']
+        result['max_inflight'] = pub.max_inflight
+    await close(sub, pub)
+    return result
+
+
+async def bench_latency(n):
+    state = {'ev': uasyncio.Event()}
+
+    def cb(topic, msg, retain):
+        state['ev'].set()
+    sub = await client('lat-sub', cb, ['bench/lat'])
+    pub = await client('lat-pub')
+    samples = []
+    for i in range(n):
+        state['ev'].clear()
+        start = time.ticks_us()
+        await pub.publish('bench/lat', b'ping')
+        await uasyncio.wait_for(state['ev'].wait(), 5)
+        samples.append(time.ticks_diff(time.ticks_us(), start))
+    await close(sub, pub)
+    return {'messages': n, 'p50_us': percentile(samples, 50),
+            'p95_us': percentile(samples, 95), 'max_us': max(samples)}
+
+
+async def bench_fanout(n, subscribers):
+    counter = Counter(n * subscribers)
+    subs = []
+    for i in range(subscribers):
+        subs.append(await client('fan%d' % i, counter.cb, ['bench/fan/#']))
+    pub = await client('fan-pub')
+    start = time.ticks_us()
+    for i in range(n):
+        await pub.publish('bench/fan/x', b'v')
+    await uasyncio.wait_for(counter.done.wait(), 30)
+    us = time.ticks_diff(counter.last, start)
+    await close(pub, *subs)
+    return {'messages': n, 'subscribers': subscribers, 'ms': us // 1000,
+            'deliveries_per_s': n * subscribers * 1000000 // max(us, 1)}
+
+
+async def bench_subscribe(n):
+    # 跟 Board.connect 一樣先登記訂閱再連線，由 _run 在連線後訂閱
+    from webduino.mqtt import MQTT
+    state = {'count': 0, 'last': 0, 'done': uasyncio.Event()}
+
+    def cb(topic, msg):
+        state['count'] += 1
+        state['last'] = time.ticks_us()
+        if state['count'] >= n:
+            state['done'].set()
+    MQTT.server = '127.0.0.1'
+    MQTT.port = PORT
+    MQTT.topic_report = 'bench/state'
+    MQTT.topic_report_msg = 'disconnect'
+    MQTT.sub('bench/sub/+/v', cb)
+    start = time.ticks_ms()
+    MQTT.connect()
+    while 'bench/sub/+/v' not in MQTT._subscribed:
+        if time.ticks_diff(time.ticks_ms(), start) > 5000:
+            raise OSError('subscribe before connect: no SUBACK')
+        await uasyncio.sleep_ms(10)
+    subscribe_ms = time.ticks_diff(time.ticks_ms(), start)
+    pub = await client('sub-pub')
+    start = time.ticks_us()
+    for i in range(n):
+        await pub.publish('bench/sub/%d/v' % (i % 8), b'v')
+        if i % 16 == 15:
+            # 每 16 筆等分派追上，不超過訂閱 lane 的容量
+            while state['count'] <= i - 16:
+                await uasyncio.sleep_ms(1)
+    await uasyncio.wait_for(state['done'].wait(), 30)
+    us = time.ticks_diff(state['last'], start)
+    await close(pub)
+    MQTT.unsub('bench/sub/+/v')
+    return {'messages': n, 'subscribe_ms': subscribe_ms, 'ms': us // 1000,
+            'msg_per_s': n * 1000000 // max(us, 1), 'failures': MQTT.reconnect_stats['failures']}
+
+
+async def bench_pipeline(n):
+    # 沿用 bench_subscribe 建立的 MQTT 連線
+    from webduino.mqtt import MQTT
+    counter = Counter(n)
+    sub = await client('pipe-sub', counter.cb, ['bench/pipe'])
+    MQTT.set_pub_queue(64)
+    while not MQTT.connected:
+        await uasyncio.sleep_ms(10)
+    topic = MQTT.intern('bench/pipe')
+    start = time.ticks_us()
+    for i in range(n):
+        MQTT.pub(topic, b'x' * 32)
+        if len(MQTT._pub_queue) >= 48:
+            await uasyncio.sleep_ms(0)
+    await uasyncio.wait_for(counter.done.wait(), 30)
+    us = time.ticks_diff(counter.last, start)
+    MQTT._run_task.cancel()
+    MQTT._pub_task.cancel()
+    MQTT.client.close()
+    await close(sub)
+    return {'messages': n, 'ms': us // 1000, 'msg_per_s': n * 1000000 // max(us, 1),
+            'dropped': MQTT._pub_queue.dropped}
+
+
+def bench_execcmd(n):
+    from webduino.board import Board
+    from webduino.mqtt import MQTT
+    from webduino.debug import debug
+    debug.level = 0
+    board = Board.__new__(Board)
+    board.mqtt = MQTT
+    board.devId = 'bench'
+    board.topic_ack = MQTT.intern('waboard/bench/ack')
+    board.topic_output = MQTT.intern('waboard/bench/output')
+    result = {}
+    for cmd in (b'ping', b'unknown'):
+        start = time.ticks_us()
+        for i in range(n):
+            board.execCmd('bench-cmd', cmd)
+            MQTT._pub_queue.clear()
+        us = time.ticks_diff(time.ticks_us(), start)
+        result[cmd.decode()] = {'calls': n, 'us_per_call': us / n}
+    return result
+
+
+async def main(n):
+    from webduino.debug import debug
+    debug.level = 0
+    broker = Broker()
+    await broker.start('127.0.0.1', PORT)
+    results = {
+        'runtime': sys.implementation.name,
+        'publish_qos0': await bench_publish(n, 0),
+        'publish_qos1': await bench_publish(n, 1),
+        'latency': await bench_latency(max(n // 10, 10)),
+        'fanout': await bench_fanout(max(n // 10, 10), 8),
+        'subscribe': await bench_subscribe(n),
+        'pipeline': await bench_pipeline(n),
+        'execcmd': bench_execcmd(n),
+    }
+    broker.close()
+    return results
+
+
+if __name__ == '__main__':
+    n = 1000
+    out = None
+    args = sys.argv[1:]
+    if '-n' in args:
+        n = int(args[args.index('-n') + 1])
+    if '-o' in args:
+        out = args[args.index('-o') + 1]
+    results = json.dumps(uasyncio.run(main(n)))
+    if out:
+        with open(out, 'w') as f:
+            f.write(results)
+    sys.stdout.write(results + '\n')
+    sys.exit(0)
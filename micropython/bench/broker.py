@@ -0,0 +1,207 @@
+"""本機 MQTT 3.1.1 broker 替身，用於測試 / 效能量測，不需連線 mqtt1.webduino.io
+
+可在 CPython 或 MicroPython unix port 執行:
+    python3 broker.py [port]
+    micropython broker.py [port]
+
+支援 CONNECT (clean / persistent session)、SUBSCRIBE (+ / # 萬用字元)、
+UNSUBSCRIBE、PUBLISH QoS 0/1、PINGREQ、DISCONNECT 與 last will，
+不支援 retained message 與 QoS 2
+"""
+import struct
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+def topic_match(topicFilter, topic):
+    f = topicFilter.split('/')
+    t = topic.split('/')
+    if topic.startswith('$') and f[0] in ('+', '#'):
+        return False
+    for i in range(len(f)):
+        if f[i] == '#':
+            return True
+        if i >= len(t):
+            return False
+        if f[i] != '+' and f[i] != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+class Session:
+
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.writer = None
+        self.subs = {}  # topic filter -> qos
+        self.pid = 0
+
+    def next_pid(self):
+        self.pid = self.pid + 1 if self.pid < 0xffff else 1
+        return self.pid
+
+
+class Broker:
+
+    def __init__(self):
+        self.sessions = {}
+        self.stats = {'connects': 0, 'received': 0, 'delivered': 0}
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=1883):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    @staticmethod
+    def pack_len(sz):
+        out = bytearray()
+        while sz > 0x7f:
+            out.append((sz & 0x7f) | 0x80)
+            sz >>= 7
+        out.append(sz)
+        return out
+
+    async def read_packet(self, reader):
+        op = (await reader.readexactly(1))[0]
+        sz = 0
+        sh = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            sz |= (b & 0x7f) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        data = await reader.readexactly(sz) if sz else b''
+        return op, data
+
+    @staticmethod
+    def read_str(data, pos):
+        n = struct.unpack_from('!H', data, pos)[0]
+        return bytes(data[pos + 2:pos + 2 + n]), pos + 2 + n
+
+    def publish_pkt(self, session, topic, msg, qos, retain=False):
+        body = bytearray(struct.pack('!H', len(topic)))
+        body += topic
+        if qos:
+            body += struct.pack('!H', session.next_pid())
+        body += msg
+        return bytes([0x30 | qos << 1 | retain]) + self.pack_len(len(body)) + body
+
+    def route(self, topic, msg, qos):
+        self.stats['received'] += 1
+        topic_str = topic.decode('utf-8')
+        for session in self.sessions.values():
+            if session.writer is None:
+                continue
+            granted = -1
+            for f, sub_qos in session.subs.items():
+                if topic_match(f, topic_str) and sub_qos > granted:
+                    granted = sub_qos
+            if granted < 0:
+                continue
+            try:
+                session.writer.write(self.publish_pkt(session, topic, msg, min(qos, granted)))
+                self.stats['delivered'] += 1
+            except Exception:
+                session.writer = None
+
+    async def handle(self, reader, writer):
+        session = None
+        will = None
+        try:
+            op, data = await self.read_packet(reader)
+            if op & 0xf0 != 0x10:
+                return
+            flags = data[7]
+            client_id, pos = self.read_str(data, 10)
+            if flags & 0x04:
+                will_topic, pos = self.read_str(data, pos)
+                will_msg, pos = self.read_str(data, pos)
+                will = (will_topic, will_msg, (flags >> 3) & 0x03)
+            clean = bool(flags & 0x02)
+            session = self.sessions.get(client_id)
+            present = 0
+            if session is None or clean:
+                session = Session(client_id, clean)
+            else:
+                present = 1
+            if session.writer:
+                try:
+                    session.writer.close()
+                except Exception:
+                    pass
+            session.writer = writer
+            session.clean = clean
+            self.sessions[client_id] = session
+            self.stats['connects'] += 1
+            writer.write(bytes([0x20, 0x02, present, 0x00]))
+            await writer.drain()
+            while True:
+                op, data = await self.read_packet(reader)
+                kind = op & 0xf0
+                if kind == 0x30:
+                    qos = (op >> 1) & 0x03
+                    topic, pos = self.read_str(data, 0)
+                    if qos:
+                        pid = struct.unpack_from('!H', data, pos)[0]
+                        pos += 2
+                        writer.write(struct.pack('!BBH', 0x40, 2, pid))
+                    self.route(topic, bytes(data[pos:]), qos)
+                elif kind == 0x80:
+                    pid = struct.unpack_from('!H', data, 0)[0]
+                    pos = 2
+                    codes = bytearray()
+                    while pos < len(data):
+                        f, pos = self.read_str(data, pos)
+                        qos = min(data[pos], 1)
+                        pos += 1
+                        session.subs[f.decode('utf-8')] = qos
+                        codes.append(qos)
+                    writer.write(bytes([0x90]) + self.pack_len(2 + len(codes)) + struct.pack('!H', pid) + codes)
+                elif kind == 0xa0:
+                    pid = struct.unpack_from('!H', data, 0)[0]
+                    pos = 2
+                    while pos < len(data):
+                        f, pos = self.read_str(data, pos)
+                        session.subs.pop(f.decode('utf-8'), None)
+                    writer.write(struct.pack('!BBH', 0xb0, 2, pid))
+                elif kind == 0xc0:
+                    writer.write(b'\xd0\x00')
+                elif kind == 0xe0:
+                    will = None
+                    break
+                # PUBACK (0x40) 不需處理
+                await writer.drain()
+        except Exception:
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    self.sessions.pop(session.client_id, None)
+            try:
+                writer.close()
+            except Exception:
+                pass
+            if will:
+                self.route(will[0], will[1], will[2])
+
+
+async def main(port=1883):
+    broker = Broker()
+    await broker.start('0.0.0.0', port)
+    print('broker listening on', port)
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    import sys
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1883))
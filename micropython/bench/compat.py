@@ -0,0 +1,89 @@
+"""讓 webduino 函式庫在 CPython / MicroPython unix port 上執行 benchmark
+
+只補上開發板才有的模組 (network / machine / ubinascii / uhashlib / uasyncio)
+與 time.ticks_* 函式，已存在的模組不會被取代
+"""
+import sys, time
+
+_here = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+sys.path.insert(0, _here + '/../lib')
+
+if not hasattr(time, 'ticks_ms'):
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_us = lambda: int(time.monotonic() * 1000000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+class _Module:
+    pass
+
+
+def _install(name, mod):
+    sys.modules[name] = mod
+    return mod
+
+
+try:
+    import uasyncio
+except ImportError:
+    import asyncio
+    uasyncio = _install('uasyncio', _Module())
+    for k in dir(asyncio):
+        if not k.startswith('_'):
+            setattr(uasyncio, k, getattr(asyncio, k))
+
+    async def _sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+    uasyncio.sleep_ms = _sleep_ms
+
+try:
+    import ubinascii
+except ImportError:
+    import binascii
+    _install('ubinascii', binascii)
+
+try:
+    import uhashlib
+except ImportError:
+    import hashlib
+    _install('uhashlib', hashlib)
+
+try:
+    import network
+except ImportError:
+    network = _install('network', _Module())
+    network.STA_IF = 0
+    network.AP_IF = 1
+
+    class _WLAN:
+        def __init__(self, *args):
+            pass
+
+        def config(self, key):
+            return b'\xbe\x4c\x00\x00\x00\x01' if key == 'mac' else None
+
+        def isconnected(self):
+            return True
+    network.WLAN = _WLAN
+
+try:
+    import machine
+    machine.reset
+except (ImportError, AttributeError):
+    machine = _install('machine', _Module())
+
+    def _reset():
+        raise SystemExit('machine.reset()')
+    machine.reset = _reset
+
+    class _Timer:
+        PERIODIC = 1
+
+        def __init__(self, *args):
+            pass
+
+        def init(self, **kwargs):
+            pass
+    machine.Timer = _Timer
@@ -0,0 +1,352 @@
+import uasyncio, time, struct
+
+
+class MQTTException(Exception):
+    pass
+
+
+class AsyncMQTTClient:
+    """MQTT 3.1.1 client，使用 uasyncio stream，不需要輪詢 check_msg
+
+    run() 持續讀取封包並呼叫 callback，同時依實際經過時間送出 PINGREQ，
+    連線中斷時 run() 會丟出例外，由呼叫端決定何時重連
+    """
+
+    def __init__(self, client_id, server, port=1883, user=None, password=None,
+                 keepalive=60, clean_session=True, max_inflight=8):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.clean_session = clean_session
+        self.cb = None
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.session_present = False
+        self.pid = 0
+        self.last_rx = 0
+        self.last_tx = 0
+        self._reader = None  # 執行 run() 的 task，close() 時取消
+        self._ping_at = 0    # 上次送出 PINGREQ 的時間
+        self._waiters = {}  # pid -> Event，等待 SUBACK
+        self._acks = {}     # pid -> SUBACK return codes
+        # QoS 1: 已送出尚未收到 PUBACK 的封包，pid -> [pkt, 送出時間]
+        self.max_inflight = max_inflight
+        self.inflight = {}
+        self._window = uasyncio.Event()
+        self._window.set()
+        self._rx_pids = [0] * 16  # 最近收到的 QoS 1 pid，過濾重送的 DUP
+        self._rx_pos = 0
+        self._pktbuf = bytearray(256)  # QoS 0 發布共用的封包 buffer
+        self.qos_stats = {'sent': 0, 'acked': 0, 'retransmits': 0, 'dups': 0,
+                          'ack_ms_total': 0, 'ack_ms_max': 0}
+
+    def set_callback(self, cb):
+        # cb(topic, msg, retain)，topic / msg 為 bytes
+        self.cb = cb
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    @staticmethod
+    def _encode(s):
+        return s.encode('utf-8') if isinstance(s, str) else s
+
+    @staticmethod
+    def _pack_len(pkt, sz):
+        while sz > 0x7f:
+            pkt.append((sz & 0x7f) | 0x80)
+            sz >>= 7
+        pkt.append(sz)
+
+    @staticmethod
+    def _pack_str(pkt, s):
+        pkt += struct.pack("!H", len(s))
+        pkt += s
+
+    def _next_pid(self):
+        self.pid = self.pid + 1 if self.pid < 0xffff else 1
+        return self.pid
+
+    def _write(self, pkt):
+        self.writer.write(pkt)
+        self.last_tx = time.ticks_ms()
+
+    async def _send(self, pkt):
+        self._write(pkt)
+        await self.writer.drain()
+
+    async def connect(self, timeout=10):
+        self.reader, self.writer = await uasyncio.wait_for(
+            uasyncio.open_connection(self.server, self.port), timeout)
+        body = bytearray(b"\x00\x04MQTT\x04\x00\x00\x00")
+        body[7] = 0x02 if self.clean_session else 0
+        struct.pack_into("!H", body, 8, self.keepalive)
+        self._pack_str(body, self._encode(self.client_id))
+        if self.lw_topic:
+            body[7] |= 0x04 | (self.lw_qos & 0x3) << 3
+            body[7] |= self.lw_retain << 5
+            self._pack_str(body, self._encode(self.lw_topic))
+            self._pack_str(body, self._encode(self.lw_msg))
+        if self.user:
+            body[7] |= 0x80
+            self._pack_str(body, self._encode(self.user))
+            if self.pswd:
+                body[7] |= 0x40
+                self._pack_str(body, self._encode(self.pswd))
+        pkt = bytearray(b"\x10")
+        self._pack_len(pkt, len(body))
+        pkt += body
+        await self._send(pkt)
+        resp = await uasyncio.wait_for(self.reader.readexactly(4), timeout)
+        if resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException("Bad CONNACK")
+        if resp[3] != 0:
+            raise MQTTException(f"Connection refused: {resp[3]}")
+        self.last_rx = time.ticks_ms()
+        self.connected = True
+        self.session_present = bool(resp[2] & 1)
+        return self.session_present
+
+    def close(self):
+        self.connected = False
+        for ev in self._waiters.values():
+            ev.set()
+        self._window.set()
+        # uasyncio 的 Stream.close() 什麼都不做，等待中的讀取不會結束，直接取消 run() 的 task
+        reader = self._reader
+        self._reader = None
+        if reader is not None and reader is not uasyncio.current_task():
+            reader.cancel()
+        if self.writer:
+            try:
+                self.writer.close()
+                # 關閉底層 socket，重連時不會留下舊連線
+                s = getattr(self.writer, 's', None)
+                if s is not None:
+                    s.close()
+            except Exception:
+                pass
+        self.reader = self.writer = None
+
+    async def disconnect(self):
+        if self.connected:
+            try:
+                await self._send(b"\xe0\x00")
+            except Exception:
+                pass
+        self.close()
+
+    def _publish_pkt(self, topic, msg, retain=False, qos=0, pid=0, dup=False):
+        topic = self._encode(topic)
+        msg = self._encode(msg)
+        pkt = bytearray()
+        pkt.append(0x30 | qos << 1 | retain | dup << 3)
+        self._pack_len(pkt, 2 + len(topic) + len(msg) + (2 if qos else 0))
+        self._pack_str(pkt, topic)
+        if qos:
+            pkt += struct.pack("!H", pid)
+        pkt += msg
+        return pkt
+
+    def window_full(self):
+        return len(self.inflight) >= self.max_inflight
+
+    async def wait_window(self):
+        while self.window_full():
+            self._window.clear()
+            await self._window.wait()
+            if not self.connected:
+                raise MQTTException("Connection lost")
+
+    def publish_nowait(self, topic, msg, retain=False, qos=0):
+        # 寫入 stream 後立即返回，不等待 drain / PUBACK
+        # QoS 1 需先確認 window_full() 為 False
+        if qos:
+            pid = self._next_pid()
+            while pid in self.inflight:
+                pid = self._next_pid()
+            pkt = self._publish_pkt(topic, msg, retain, 1, pid)
+            self.inflight[pid] = [pkt, time.ticks_ms()]
+            self.qos_stats['sent'] += 1
+            self._write(pkt)
+            return pid
+        self._write_qos0(topic, msg, retain)
+        return 0
+
+    def _write_qos0(self, topic, msg, retain):
+        # 組在共用 buffer 中再寫入 stream (stream 會複製未送出的部分)，不必每筆配置封包
+        topic = self._encode(topic)
+        msg = self._encode(msg)
+        tlen = len(topic)
+        mlen = len(msg)
+        sz = 2 + tlen + mlen
+        buf = self._pktbuf
+        if sz + 5 > len(buf):
+            self._write(self._publish_pkt(topic, msg, retain, 0))
+            return
+        buf[0] = 0x30 | retain
+        i = 1
+        while sz > 0x7f:
+            buf[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        buf[i + 1] = tlen >> 8
+        buf[i + 2] = tlen & 0xff
+        i += 3
+        buf[i:i + tlen] = topic
+        i += tlen
+        buf[i:i + mlen] = msg
+        i += mlen
+        self._write(memoryview(buf)[:i])
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        # QoS 1 只等待 in-flight window 有空位，不逐筆等待 PUBACK
+        if qos:
+            await self.wait_window()
+        pid = self.publish_nowait(topic, msg, retain, qos)
+        await self.writer.drain()
+        return pid
+
+    def resend_inflight(self):
+        # 重連後以 DUP 旗標重送尚未確認的 QoS 1 封包
+        for pid, entry in self.inflight.items():
+            entry[0][0] |= 0x08
+            entry[1] = time.ticks_ms()
+            self.qos_stats['retransmits'] += 1
+            self._write(entry[0])
+
+    async def subscribe(self, topics, qos=0, timeout=10):
+        # topics 可以是單一 topic 或 list，合併成一個 SUBSCRIBE 封包
+        # 每個 topic 可以是 str 或 (topic, qos)
+        if not isinstance(topics, (list, tuple)):
+            topics = [topics]
+        pid = self._next_pid()
+        body = bytearray(struct.pack("!H", pid))
+        for t in topics:
+            t_qos = qos
+            if isinstance(t, tuple):
+                t, t_qos = t
+            self._pack_str(body, self._encode(t))
+            body.append(t_qos)
+        pkt = bytearray(b"\x82")
+        self._pack_len(pkt, len(body))
+        pkt += body
+        ev = self._waiters[pid] = uasyncio.Event()
+        try:
+            await self._send(pkt)
+            await uasyncio.wait_for(ev.wait(), timeout)
+        finally:
+            del self._waiters[pid]
+        codes = self._acks.pop(pid, None)
+        if codes is None:
+            raise MQTTException("Connection lost before SUBACK")
+        for code in codes:
+            if code == 0x80:
+                raise MQTTException(f"Subscribe rejected: {topics}")
+        return codes
+
+    async def ping(self):
+        self._ping_at = time.ticks_ms()
+        await self._send(b"\xc0\x00")
+
+    async def _recv_len(self):
+        n = 0
+        sh = 0
+        while True:
+            b = (await self.reader.readexactly(1))[0]
+            n |= (b & 0x7f) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    async def _read_packet(self):
+        op = (await self.reader.readexactly(1))[0]
+        sz = await self._recv_len()
+        data = await self.reader.readexactly(sz) if sz else b""
+        self.last_rx = time.ticks_ms()
+        return op, data
+
+    def _handle(self, op, data):
+        kind = op & 0xf0
+        if kind == 0x30:
+            qos = (op >> 1) & 0x03
+            tlen = struct.unpack_from("!H", data, 0)[0]
+            topic = data[2:2 + tlen]
+            pos = 2 + tlen
+            if qos:
+                pid = struct.unpack_from("!H", data, pos)[0]
+                pos += 2
+                self._write(struct.pack("!BBH", 0x40, 2, pid))  # PUBACK
+                if op & 0x08 and pid in self._rx_pids:
+                    # broker 重送且已收過，回 PUBACK 但不再分派
+                    self.qos_stats['dups'] += 1
+                    return
+                self._rx_pids[self._rx_pos] = pid
+                self._rx_pos = (self._rx_pos + 1) % len(self._rx_pids)
+            if self.cb:
+                self.cb(topic, data[pos:], op & 1)
+        elif kind == 0x40:
+            pid = struct.unpack_from("!H", data, 0)[0]
+            entry = self.inflight.pop(pid, None)
+            if entry:
+                stats = self.qos_stats
+                ms = time.ticks_diff(time.ticks_ms(), entry[1])
+                stats['acked'] += 1
+                stats['ack_ms_total'] += ms
+                if ms > stats['ack_ms_max']:
+                    stats['ack_ms_max'] = ms
+                self._window.set()
+        elif kind == 0x90:
+            pid = struct.unpack_from("!H", data, 0)[0]
+            ev = self._waiters.get(pid)
+            if ev:
+                self._acks[pid] = data[2:]
+                ev.set()
+        # PINGRESP (0xd0) 只需更新 last_rx
+
+    async def _keepalive(self):
+        interval = self.keepalive * 1000
+        while self.connected:
+            await uasyncio.sleep_ms(1000)
+            now = time.ticks_ms()
+            if time.ticks_diff(now, self.last_rx) > interval * 3 // 2:
+                # 超過 1.5 倍 keepalive 沒收到任何封包，視為斷線
+                self.close()
+                return
+            # 只發布不接收時 last_tx 一直在更新，收不到封包的時間過半也要 ping，
+            # 讓 broker 回 PINGRESP 更新 last_rx (上一個 PINGREQ 還沒回應時不重送)
+            if time.ticks_diff(now, self.last_tx) >= interval // 2 or \
+                    (time.ticks_diff(now, self.last_rx) >= interval // 2 and
+                     time.ticks_diff(self._ping_at, self.last_rx) <= 0):
+                await self.ping()
+
+    async def run(self):
+        # 持續讀取封包直到連線中斷，結束時丟出例外
+        self._reader = uasyncio.current_task()
+        ka = uasyncio.create_task(self._keepalive()) if self.keepalive else None
+        try:
+            while self.connected:
+                op, data = await self._read_packet()
+                self._handle(op, data)
+        except uasyncio.CancelledError:
+            # close() 取消時 _reader 已清除，其他情況 (例如外部取消) 照常往外丟
+            if self._reader is not None:
+                raise
+        finally:
+            if ka:
+                ka.cancel()
+            self._reader = None
+            self.close()
+        raise MQTTException("Connection closed")
@@ -3,22 +3,30 @@ from webduino.mqtt import MQTT
 from webduino.config import Config
 from webduino.debug import debug
 from webduino.webserver import WebServer
+from webduino.manifest import Manifest
+from webduino.codecache import CodeCache
+from webduino.capture import OutputCapture
+from webduino.status import DeviceStatus
+from webduino.logfwd import LogForwarder
+from webduino.ota import OTA
+from webduino.transfer import ReadStream, UploadStream, DeltaStream, BundleStream, fileHashes
 import time, uasyncio, machine, os, builtins, ubinascii, network
 
 original_print = builtins.print
 # 定義自訂的 print 方法
 
 def custom_print(*args, **kwargs):
-    modified_args = args
-    if 'board' in globals():
+    # code 指令執行中的輸出 (包含 ! 開頭) 收集起來分批回傳
+    if 'board' in globals() and Board.capture is not None and not Board.capture.flushing and 'file' not in kwargs:
+        Board.capture.print(args, kwargs)
+    # 先判斷第一個參數開頭是 ! 才交給 LogForwarder，一般 print 不產生額外字串
+    # LogForwarder 先檢查 level 再組字串，多行合併成一則訊息送出
+    elif args and type(args[0]) is str and args[0].startswith('!'):
         try:
-            message = ' '.join(map(str, args))
-            # 判斷 message 開頭是 ! 才傳送
-            if message.startswith('!'):
-                board.mqtt.pub(f'waboard/{board.devId}/output', message)
+            LogForwarder.log(LogForwarder.INFO, args)
         except:
             pass
-    original_print(*modified_args, **kwargs)
+    original_print(*args, **kwargs)
 
 
 builtins.print = custom_print
@@ -43,14 +51,24 @@ builtins.print = custom_print
 class Board:
 
     Ver = '0.3.2'
-
-    def __init__(self, devId='', mqtt=False, mqttServer='', topic_report='waboard/state', topic_report_msg='disconnect', state_callback=None):
+    max_running = 2   # 同時執行的 async 指令上限
+    uncapped = ('reboot',)  # 不受 max_running 限制的指令，重啟不能因為忙碌被拒絕
+    _running = 0
+    cmd_stats = {}    # 指令名稱 -> [次數, 總時間 ms, 最長時間 ms]
+    code_cache = CodeCache(8)  # code 指令編譯結果
+    capture = None             # code 指令執行中收集 print 輸出的 OutputCapture
+    _replies = None            # batch 執行中收集子指令回覆的 list
+
+    def __init__(self, devId='', mqtt=False, mqttServer='', topic_report='waboard/state', topic_report_msg='disconnect', state_callback=None, clean_session=True):
         debug.off()
+        # 完成中斷的 OTA 替換，或在新版本健康檢查失敗時還原
+        OTA.boot()
         self.wifi = WiFi
         self.mqtt = MQTT
         self.wifi.onlilne(self.online)
         self.config = Config
         self.state_callback = state_callback
+        self.clean_session = clean_session
         self.now = 0
         self.devices = []
         json = self.config.load()
@@ -67,6 +85,10 @@ class Board:
         self.topic_report_msg = topic_report_msg
         self.config.save()
         self.devId = devId
+        # 常用的發布 topic 先轉成 bytes
+        self.topic_ack = MQTT.intern(f"waboard/{devId}/ack")
+        self.topic_output = MQTT.intern(f"waboard/{devId}/output")
+        LogForwarder.setup(MQTT, self.topic_output)
         self.devPasswd = json['devPasswd']
         if self.state_callback != None:
             self.state_callback(self, ['cfg',''])
@@ -117,7 +139,7 @@ class Board:
             self.mqtt.server = self.mqttServer
             self.mqtt.topic_report = self.topic_report
             self.mqtt.topic_report_msg = self.topic_report_msg
-            self.mqtt.connect()
+            self.mqtt.connect(clean_session=self.clean_session)
             debug.print("connect mqtt...OK")
         else:
             debug.print("offline...")
@@ -164,8 +186,11 @@ class Board:
                         # 連接成功
                         debug.INFO(f"WiFi {current_ssid} Ready , MQTT Ready , ready to go...")
                         # 限制只能接收訂閱 ${deviceId} 底下
-                        self.mqtt.sub(self.devId+"-cmd", self.execCmd)
+                        self.mqtt.sub(self.devId+"-cmd", self.execCmd, priority=self.mqtt.PRIO_HIGH)
+                        # save <path> bin 的二進位資料 frame
+                        self.mqtt.sub(self.devId+"-upload", self.uploadFrame)
                         self.report('boot')
+                        OTA.started(self.mqtt)
                         return self
                     elif connect_result == False:
                         # WiFi.connect明確返回失敗，不再嘗試當前配置，直接嘗試下一個
@@ -183,374 +208,571 @@ class Board:
         machine.reset()
         return self
 
-    def sub(self, topic, cb):
-        self.mqtt.sub(topic, cb)
+    def sub(self, topic, cb, qos=0, priority=1):
+        self.mqtt.sub(topic, cb, qos, priority)
 
     def pub(self, topic, msg, retain=False,qos=0):
-        self.mqtt.pub(topic, msg, retain)
+        self.mqtt.pub(topic, msg, retain, qos)
 
     def ping(self):
-        self.mqtt.client.ping()
+        uasyncio.create_task(self.mqtt.client.ping())
+
+    def startMetrics(self, interval=60):
+        # 定期發布 waboard/<devId>/metrics，找出處理較慢的 topic
+        uasyncio.create_task(self._metrics_loop(interval))
+
+    async def _metrics_loop(self, interval):
+        import json
+        while True:
+            await uasyncio.sleep(interval)
+            summary = self.mqtt.metrics.summary()
+            if summary:
+                self.mqtt.pub(f"waboard/{self.devId}/metrics", json.dumps(summary))
+                self.mqtt.metrics.reset()
 
     def report(self, cmd):
+        if self._replies is not None:
+            # batch 子指令的回覆合併到最後一則訊息
+            self._replies.append(cmd)
+            return
         #debug.print(f"waboard/{self.devId}/ack {cmd}")
-        debug.print(f"waboard/{self.devId}/ack {len(cmd)}")
-        self.mqtt.pub(f"waboard/{self.devId}/ack", cmd)
+        if debug.state:
+            debug.print(f"waboard/{self.devId}/ack {len(cmd)}")
+        self.mqtt.pub(self.topic_ack, cmd)
         debug.print("publish OK")
 
+    def uploadFrame(self, topic, data):
+        UploadStream.frame(self, data)
+
     def execCmd(self, topic, data):
         dataArgs = data.decode('UTF-8').split(' ')
         debug.print("exceCmd:", dataArgs)
         cmd = dataArgs[0]
+        handler = self.commands.get(cmd)
+        if handler is None:
+            debug.print(f"execCmd unknown command: {cmd}")
+            return
+        start = time.ticks_ms()
         try:
-            if cmd == 'reboot':
-                self.report('reboot')
-                time.sleep(1)
-                debug.print("restart...")
-                machine.reset()
-
-            elif cmd == 'ping':
-                self.report('ping pong')
-
-            elif cmd == 'info':
-                import sys
-                import gc
-                import os
-                import json
-                version = sys.version
-                rssi = self.wifi.sta.status('rssi')
-                ip = self.wifi.sta.ifconfig()[0]
-                total_mem = (gc.mem_alloc() + gc.mem_free()) / \
-                    1024  # Convert to KB
-                free_mem = gc.mem_free() / 1024  # Convert to KB
-                storage_stats = os.statvfs('/')
-                block_size = storage_stats[0]  # Block size
-                total_blocks = storage_stats[2]  # Total blocks
-                free_blocks = storage_stats[3]  # Free blocks
-                total_storage = (block_size * total_blocks) / 1024  # Convert to KB
-                free_storage = (block_size * free_blocks) / 1024  # Convert to KB
-                main_first_line = "Not found"
-                boot_first_line = "Not found"
-                try:
-                    with open('main.py', 'r') as f:
-                        main_first_line = f.readline().strip()
-                except:
-                    pass
+            result = handler(self, dataArgs)
+            if hasattr(result, 'send'):
+                self._spawn(cmd, result, start)
+                return
+        except Exception as e:
+            debug.print(f"execCmd error: {str(e)}")
+            self.report(f'execCmd error: {str(e)}')
+        self._cmdDone(cmd, start)
+
+    def _spawn(self, cmd, coro, start):
+        # coroutine handler: 以 uasyncio task 執行，不阻塞 MQTT 接收
+        if Board._running >= Board.max_running and cmd not in Board.uncapped:
+            coro.close()
+            self.report(f'error:busy {cmd}')
+            return False
+        Board._running += 1
+        uasyncio.create_task(self._runCmd(cmd, coro, start))
+        return True
+
+    async def _runCmd(self, cmd, coro, start):
+        try:
+            await coro
+        except Exception as e:
+            debug.print(f"execCmd error: {str(e)}")
+            self.report(f'execCmd error: {str(e)}')
+        finally:
+            Board._running -= 1
+            self._cmdDone(cmd, start)
+
+    def _cmdDone(self, cmd, start):
+        # 記錄每個指令的執行次數 / 總時間 / 最長時間 (ms)
+        duration = time.ticks_diff(time.ticks_ms(), start)
+        stat = Board.cmd_stats.get(cmd)
+        if stat is None:
+            stat = Board.cmd_stats[cmd] = [0, 0, 0]
+        stat[0] += 1
+        stat[1] += duration
+        if duration > stat[2]:
+            stat[2] = duration
+        if debug.state:
+            debug.print(f"execCmd {cmd} took {duration} ms")
+
+    @staticmethod
+    def registerCmd(name, handler):
+        # handler(board, args)，可以是一般函式或 async 函式
+        # 一般函式失敗時回傳 False (batch 的 status 為 error)，其他回傳值視為成功
+        Board.commands[name] = handler
+
+    async def _cmd_reboot(self, dataArgs):
+        self.report('reboot')
+        LogForwarder.flush()
+        self.mqtt.flush_now()
+        await uasyncio.sleep(1)
+        debug.print("restart...")
+        machine.reset()
 
-                try:
-                    with open('boot.py', 'r') as f:
-                        boot_first_line = f.readline().strip()
-                except:
-                    pass
-
-                # Create info dictionary
-                info_dict = {
-                    "micropython": version,
-                    "network": {
-                        "ip": ip,
-                        "wifi_signal": rssi
-                    },
-                    "memory": {
-                        "total": round(total_mem, 2),
-                        "free": round(free_mem, 2),
-                        "unit": "KB"
-                    },
-                    "storage": {
-                        "total": round(total_storage, 2),
-                        "free": round(free_storage, 2),
-                        "unit": "KB"
-                    },
-                    "files": {
-                        "main.py": main_first_line,
-                        "boot.py": boot_first_line
-                    }
+    def _cmd_ping(self, dataArgs):
+        self.report('ping pong')
+
+    def _cmd_stats(self, dataArgs):
+        import json
+        self.report('stats ' + json.dumps({'cmd': Board.cmd_stats, 'mqtt': self.mqtt.queue_stats(),
+                                           'log': LogForwarder.stats}))
+
+    def _cmd_info(self, dataArgs):
+        # info: 完整資料 / info delta: 只回傳與上次查詢不同的欄位
+        import json
+        info = DeviceStatus.snapshot(self)
+        info['code_cache'] = Board.code_cache.stats()
+        if len(dataArgs) > 1 and dataArgs[1] == 'delta':
+            self.report('info delta ' + json.dumps(DeviceStatus.delta(info)))
+            return
+        DeviceStatus.last = info
+        info_json = json.dumps(info)
+        self.report(f'info {info_json}')
+        debug.print(f"System info: {info_json}")
+
+    def _cmd_code(self, dataArgs):
+        try:
+            import json
+            if len(dataArgs) < 2:
+                response = {
+                    'state': False,
+                    'err': 'No code provided',
+                    'output': ''
                 }
+                self.report(f'code {str(response)}')
+                return False
+
+            code = ' '.join(dataArgs[1:])
+            debug.print("Executing code:", code)
+            # 相同的程式片段直接使用 cache 中編譯好的結果
+            key, (compiled, restart) = Board.code_cache.compile(code)
+            response = self._exec(compiled, key)
+            if not response['state']:
+                self.report('code ' + json.dumps(response))
+                return False
+
+            # 將結果轉換為 JSON 字串並回傳
+            result = json.dumps(response)
+            self.report(f'code {result}')
+            # 如果code開頭是#AFTER_RESTART，則重啟設備
+            if restart:
+                # 创建非同步任務來處理重啟操作
+                uasyncio.create_task(self._delayed_reset(2))
 
-                # Convert to JSON string
-                info_json = json.dumps(info_dict)
+        except Exception as e:
+            debug.print("Code execution error:", str(e))
+            response = {
+                'state': False,
+                'err': str(e),
+                'output': ''
+            }
+            result = json.dumps(response)
+            self.report(f'code {result}')
+            return False
+
+    def _cmd_read(self, dataArgs):
+        # read <path> stream [chunk] [window] 與 read ack|resend|cancel <id> 為視窗式串流下載
+        if len(dataArgs) > 2 and dataArgs[1] in ReadStream.CONTROL:
+            return ReadStream.control(self, dataArgs)
+        if len(dataArgs) > 2 and dataArgs[2] == 'stream':
+            return ReadStream.start(self, dataArgs)
+        return self._readChunk(dataArgs)
+
+    async def _readChunk(self, dataArgs):
+        # read <path> <seek> <size>: 一次回傳一個區塊
+        try:
+            filepath = dataArgs[1]
+            read_seek = int(dataArgs[2])
+            chunk_size = int(dataArgs[3])
+            print(f" >>> chunk size: {chunk_size}")
+
+            # 只讀取指定位置的區塊
+            with open(filepath, 'rb') as f:
+                f.seek(read_seek)  # 移動到指定位置
+                chunk = f.read(chunk_size)  # 讀取指定大小的區塊
+                # 使用 ubinascii.b2a_base64() 進行編碼，並移除結尾的換行符
+                encoded_chunk = ubinascii.b2a_base64(
+                    chunk).decode('utf-8').rstrip()
+            # 等待發布佇列有空位，取代固定的 sleep(1)
+            await self.mqtt.apub(self.topic_ack, f"read data {encoded_chunk}")
 
-                self.report(f'info {info_json}')
-                debug.print(f"System info: {info_json}")
+        except Exception as e:
+            self.report(f"read error {str(e)}")
 
-            elif cmd == 'code':
-                try:
-                    import json
-                    if len(dataArgs) < 2:
-                        response = {
-                            'state': False,
-                            'err': 'No code provided',
-                            'output': ''
-                        }
-                        self.report(f'code {str(response)}')
-                        return
-
-                    code = ' '.join(dataArgs[1:])
-                    debug.print("Executing code:", code)
-
-                    # 設置執行標誌
-                    global _EXECUTING_CODE
-                    _EXECUTING_CODE = True
+    def _cmd_hashes(self, dataArgs):
+        # hashes <path> [block]: 回傳每個區塊的 crc32 與 sha256，給 delta 上傳使用
+        try:
+            import json
+            block = int(dataArgs[2]) if len(dataArgs) > 2 else 1024
+            self.report('hashes ' + json.dumps(fileHashes(dataArgs[1], block)))
+        except Exception as e:
+            self.report(f'hashes error {str(e)}')
+            return False
+
+    def _cmd_list(self, dataArgs):
+        try:
+            import os
+            import json
+
+            # 如果没有提供路径默认为根目录
+            path = dataArgs[1] if len(dataArgs) > 1 else '/'
+
+            # list <path> tree [page] [size]: 從檔案索引分頁回傳整個目錄樹
+            # list <path> rebuild: 重新掃描檔案系統建立索引
+            mode = dataArgs[2] if len(dataArgs) > 2 else ''
+            if mode in ('tree', 'rebuild'):
+                return self._listTree(path, mode, dataArgs)
+
+            # 确保路径以 / 结尾
+            if not path.endswith('/'):
+                path += '/'
 
+            result_list = []
+            # 将当前路径作为第一个元素
+            result_list.append(path)
+
+            # 遍历目录
+            for entry in os.ilistdir(path):
+                name = entry[0]
+                type_id = entry[1]
+
+                # 确定文件类型
+                entry_type = 'd' if type_id == 0x4000 else 'f'
+
+                # 获取文件大小
+                size = 0
+                if entry_type == 'f':
                     try:
-                        # 執行代碼
-                        exec(code)
-                    finally:
-                        # 確保標誌被重置
-                        _EXECUTING_CODE = False
-
-                    response = {
-                        'state': True,
-                        'err': '',
-                        'output': ''
-                    }
-                    # 將結果轉換為 JSON 字串並回傳
-                    result = json.dumps(response)
-                    self.report(f'code {result}')
-                    # 如果code開頭是#AFTER_RESTART，則重啟設備
-                    if code.startswith('#AFTER_RESTART'):
-                        # 创建非同步任務來處理重啟操作
-                        uasyncio.create_task(self._delayed_reset(2))
-                        
-                    response = {
-                        'state': True,
-                        'err': '',
-                        'output': ''
-                    }
-                    # 將結果轉換為 JSON 字串並回傳
-                    result = json.dumps(response)
-                    self.report(f'code {result}')
+                        size = os.stat(path + name)[6]
+                    except:
+                        size = 0
 
-                except Exception as e:
-                    debug.print("Code execution error:", str(e))
-                    response = {
-                        'state': False,
-                        'err': str(e),
-                        'output': ''
-                    }
-                    result = json.dumps(response)
-                    self.report(f'code {result}')
-
-            elif cmd == 'read':
-                try:
-                    filepath = dataArgs[1]
-                    read_seek = int(dataArgs[2])
-                    chunk_size = int(dataArgs[3])
-                    print(f" >>> chunk size: {chunk_size}")
-                    # 先取得檔案大小
-                    #import os
-                    #file_size = os.stat(filepath)[6]  # 取得檔案大小
-                    #self.report(f"read size {file_size}")
-
-                    # 只讀取指定位置的區塊
-                    import ubinascii
-                    with open(filepath, 'rb') as f:
-                        f.seek(read_seek)  # 移動到指定位置
-                        chunk = f.read(chunk_size)  # 讀取指定大小的區塊
-                        # 使用 ubinascii.b2a_base64() 進行編碼，並移除結尾的換行符
-                        encoded_chunk = ubinascii.b2a_base64(
-                            chunk).decode('utf-8').rstrip()
-                        self.report(f"read data {encoded_chunk}")
-                        time.sleep(1)
+                # 添加 [类型, 名称, 大小] 的数组
+                result_list.append([entry_type, name, size])
 
-                except Exception as e:
-                    self.report(f"read error {str(e)}")
+            # 将结果转换为 JSON 字符串并返回
+            result = json.dumps(result_list)
+            self.report(f'list {result}')
 
-            elif cmd == 'list':
+        except Exception as e:
+            error_msg = f'List command failed: {str(e)}'
+            debug.print(error_msg)
+            self.report(f'list error: {error_msg}')
+            return False
+
+    async def _listTree(self, path, mode, dataArgs):
+        # 建立索引需要掃描整個檔案系統，以 task 執行，不阻塞 MQTT 接收
+        import json
+        try:
+            if mode == 'rebuild':
+                Manifest.rebuild()
+            await Manifest.ready()
+            page = int(dataArgs[3]) if len(dataArgs) > 3 else 0
+            size = int(dataArgs[4]) if len(dataArgs) > 4 else 50
+            self.report('list tree ' + json.dumps(Manifest.page(path, page, size)))
+        except Exception as e:
+            self.report(f'list error: List command failed: {str(e)}')
+
+    def _cmd_save(self, dataArgs):
+        try:
+            # 檢查是否有檔案名稱參數
+            if len(dataArgs) < 3:  # save <path> <command>
+                self.report('error:Invalid save command format')
+                return False
+
+            filepath = dataArgs[1]  # 取得檔案路徑
+            subcmd = dataArgs[2]    # 取得子命令 (size/data/complete/bin)
+
+            # 二進位分塊上傳: save <path> bin <size> [window] / save cancel <id>
+            if subcmd == 'bin':
+                return UploadStream.start(self, dataArgs)
+            # 只上傳變動的區塊: save <path> delta <size> <sha256> <block> <ops> [window]
+            if subcmd == 'delta':
+                return DeltaStream.start(self, dataArgs)
+            # 多個檔案打包成一個串流: save <dir> bundle <size> [window]
+            if subcmd == 'bundle':
+                return BundleStream.start(self, dataArgs)
+            if filepath in UploadStream.CONTROL:
+                return UploadStream.control(self, dataArgs)
+
+            # 處理檔案大小資訊
+            if subcmd.startswith('size:'):
                 try:
-                    import os
-                    import json
-
-                    # 如果没有提供路径默认为根目录
-                    path = dataArgs[1] if len(dataArgs) > 1 else '/'
-
-                    # 确保路径以 / 结尾
-                    if not path.endswith('/'):
-                        path += '/'
-
-                    result_list = []
-                    # 将当前路径作为第一个元素
-                    result_list.append(path)
-
-                    # 遍历目录
-                    for entry in os.ilistdir(path):
-                        name = entry[0]
-                        type_id = entry[1]
-                        
-                        # 确定文件类型
-                        entry_type = 'd' if type_id == 0x4000 else 'f'
-                        
-                        # 获取文件大小
-                        size = 0
-                        if entry_type == 'f':
-                            try:
-                                size = os.stat(path + name)[6]
-                            except:
-                                size = 0
-                        
-                        # 添加 [类型, 名称, 大小] 的数组
-                        result_list.append([entry_type, name, size])
-
-                    # 将结果转换为 JSON 字符串并返回
-                    result = json.dumps(result_list)
-                    self.report(f'list {result}')
+                    self.file_size = int(subcmd.split(':')[1])
+                    self.bytes_received = 0
 
-                except Exception as e:
-                    error_msg = f'List command failed: {str(e)}'
-                    debug.print(error_msg)
-                    self.report(f'list error: {error_msg}')
+                    # 確保目標目錄存在
+                    try:
+                        import os
+                        parts = filepath.split('/')[:-1]
+                        if parts:
+                            current_path = ''
+                            for part in parts:
+                                if part:
+                                    current_path += '/' + part if current_path else part
+                                    try:
+                                        os.mkdir(current_path)
+                                    except OSError:
+                                        pass
+                    except Exception as e:
+                        self.report(f'error:Failed to create directory: {str(e)}')
+                        return False
+
+                    # 開啟檔案準備寫入
+                    try:
+                        self.file = open(filepath, 'wb')
+                        self.filepath = filepath
+                        self.report('ready')
+                    except OSError as e:
+                        self.report(f'error:Failed to open file: {str(e)}')
+                        return False
+                    return
+                except ValueError as e:
+                    self.report(f'error:Invalid file size format: {str(e)}')
+                    return False
+
+            # 處理檔案內容
+            if subcmd.startswith('data'):
+                if not hasattr(self, 'file'):
+                    self.report('error:No file transfer initiated')
+                    return False
 
-            elif cmd == 'save':
                 try:
-                    # 檢查是否有檔案名稱參數
-                    if len(dataArgs) < 3:  # save <path> <command>
-                        self.report('error:Invalid save command format')
-                        return
-
-                    filepath = dataArgs[1]  # 取得檔案路徑
-                    subcmd = dataArgs[2]    # 取得子命令 (size/data/complete)
-
-                    # 處理檔案大小資訊
-                    if subcmd.startswith('size:'):
-                        try:
-                            self.file_size = int(subcmd.split(':')[1])
-                            self.bytes_received = 0
-
-                            # 確保目標目錄存在
-                            try:
-                                import os
-                                parts = filepath.split('/')[:-1]
-                                if parts:
-                                    current_path = ''
-                                    for part in parts:
-                                        if part:
-                                            current_path += '/' + part if current_path else part
-                                            try:
-                                                os.mkdir(current_path)
-                                            except OSError:
-                                                pass
-                            except Exception as e:
-                                self.report(f'error:Failed to create directory: {str(e)}')
-                                return
-
-                            # 開啟檔案準備寫入
-                            try:
-                                self.file = open(filepath, 'wb')
-                                self.filepath = filepath
-                                self.report('ready')
-                            except OSError as e:
-                                self.report(f'error:Failed to open file: {str(e)}')
-                            return
-                        except ValueError as e:
-                            self.report(f'error:Invalid file size format: {str(e)}')
-                            return
-
-                    # 處理檔案內容
-                    if subcmd.startswith('data'):
-                        if not hasattr(self, 'file'):
-                            self.report('error:No file transfer initiated')
-                            return
-
-                        try:
-                            # 解析 seek 位置和資料
-                            parts = subcmd.split(' ', 1)
-                            if len(parts) == 2:
-                                seek_pos = int(parts[0].split(':')[1])
-                                data = parts[1]
-                            else:
-                                seek_pos = self.bytes_received
-                                data = subcmd[5:]  # 跳過 'data:' 前綴
-
-                            # 設定檔案指標位置
-                            self.file.seek(seek_pos)
-                            
-                            # 解碼並寫入資料
-                            import ubinascii
-                            chunk = ubinascii.a2b_base64(data)
-                            self.file.write(chunk)
-                            self.bytes_received = max(self.bytes_received, seek_pos + len(chunk))
-                            
-                            # 回報寫入成功
-                            self.report(f'write {seek_pos} {len(chunk)}')
-                        except Exception as e:
-                            self.file.close()
-                            del self.file
-                            self.report(f'error:Failed to write chunk: {str(e)}')
-                        return
-
-                    # 處理完成訊息
-                    if subcmd.startswith('complete'):
-                        if not hasattr(self, 'file'):
-                            self.report('error:No file transfer initiated')
-                            return
-
-                        try:
-                            # 檢查是否有指定最終大小
-                            parts = subcmd.split(':')
-                            final_size = int(parts[1]) if len(parts) > 1 else self.file_size
-
-                            # 關閉檔案
-                            self.file.close()
-
-                            # 檢查檔案大小
-                            import os
-                            actual_size = os.stat(self.filepath)[6]
-                            if actual_size != final_size:
-                                self.report(f'error:Size mismatch. Expected {final_size}, got {actual_size}')
-                                return
-
-                            # 清理資源
-                            del self.file
-                            del self.file_size
-                            del self.bytes_received
-
-                            self.report(f'save success {self.filepath}')
-                        except Exception as e:
-                            self.report(f'error:Failed to complete file: {str(e)}')
-                        return
+                    # 解析 seek 位置和資料
+                    parts = subcmd.split(' ', 1)
+                    if len(parts) == 2:
+                        seek_pos = int(parts[0].split(':')[1])
+                        data = parts[1]
+                    else:
+                        seek_pos = self.bytes_received
+                        data = subcmd[5:]  # 跳過 'data:' 前綴
+
+                    # 設定檔案指標位置
+                    self.file.seek(seek_pos)
+
+                    # 解碼並寫入資料
+                    import ubinascii
+                    chunk = ubinascii.a2b_base64(data)
+                    self.file.write(chunk)
+                    self.bytes_received = max(self.bytes_received, seek_pos + len(chunk))
 
+                    # 回報寫入成功
+                    self.report(f'write {seek_pos} {len(chunk)}')
                 except Exception as e:
-                    if hasattr(self, 'file'):
-                        self.file.close()
-                        del self.file
-                    self.report(f'error:Save operation failed: {str(e)}')
-
-            elif cmd == 'time':
-                if len(dataArgs) < 2:
-                    self.report('error:No timestamp provided')
-                    return
-                from lib.clock import Clock
-                timestamp = int(dataArgs[1])
-                self.clock = Clock(timestamp)
-                current_time = self.clock.get()
-                self.report(f'time {current_time}')
-                self.state_callback(self,['time',current_time])
-                debug.print(f"Time set to: {current_time} , callback...")
-
-            elif cmd == 'delete':
+                    self.file.close()
+                    del self.file
+                    self.report(f'error:Failed to write chunk: {str(e)}')
+                    return False
+                return
+
+            # 處理完成訊息
+            if subcmd.startswith('complete'):
+                if not hasattr(self, 'file'):
+                    self.report('error:No file transfer initiated')
+                    return False
+
                 try:
-                    if len(dataArgs) < 2:
-                        self.report('error:No file path provided')
-                        return
+                    # 檢查是否有指定最終大小
+                    parts = subcmd.split(':')
+                    final_size = int(parts[1]) if len(parts) > 1 else self.file_size
+
+                    # 關閉檔案
+                    self.file.close()
+
+                    # 檢查檔案大小
                     import os
-                    filepath = dataArgs[1]
-                    try:
-                        # 嘗試作為檔案刪除
-                        os.remove(filepath)
-                        debug.print(f"File deleted: {filepath}")
-                        self.report(f'delete ok')
-                    except OSError:
-                        os.rmdir(filepath)
-                        debug.print(f"Directory deleted: {filepath}")
-                        self.report(f'delete success {filepath}')
+                    actual_size = os.stat(self.filepath)[6]
+                    if actual_size != final_size:
+                        self.report(f'error:Size mismatch. Expected {final_size}, got {actual_size}')
+                        return False
+
+                    Manifest.update(self.filepath)
+                    # 清理資源
+                    del self.file
+                    del self.file_size
+                    del self.bytes_received
+
+                    self.report(f'save success {self.filepath}')
                 except Exception as e:
-                    error_msg = f'Delete command failed: {str(e)}'
-                    debug.print(error_msg)
-                    self.report(f'delete error: {error_msg}')
+                    self.report(f'error:Failed to complete file: {str(e)}')
+                    return False
+                return
+
         except Exception as e:
-            debug.print(f"execCmd error: {str(e)}")
-            self.report(f'execCmd error: {str(e)}')
+            if hasattr(self, 'file'):
+                self.file.close()
+                del self.file
+            self.report(f'error:Save operation failed: {str(e)}')
+            return False
+
+    def _cmd_time(self, dataArgs):
+        if len(dataArgs) < 2:
+            self.report('error:No timestamp provided')
+            return False
+        from lib.clock import Clock
+        timestamp = int(dataArgs[1])
+        self.clock = Clock(timestamp)
+        current_time = self.clock.get()
+        self.report(f'time {current_time}')
+        self.state_callback(self,['time',current_time])
+        debug.print(f"Time set to: {current_time} , callback...")
+
+    def _cmd_delete(self, dataArgs):
+        try:
+            if len(dataArgs) < 2:
+                self.report('error:No file path provided')
+                return False
+            import os
+            filepath = dataArgs[1]
+            try:
+                # 嘗試作為檔案刪除
+                os.remove(filepath)
+                Manifest.remove(filepath)
+                debug.print(f"File deleted: {filepath}")
+                self.report(f'delete ok')
+            except OSError:
+                os.rmdir(filepath)
+                Manifest.remove(filepath)
+                debug.print(f"Directory deleted: {filepath}")
+                self.report(f'delete success {filepath}')
+        except Exception as e:
+            error_msg = f'Delete command failed: {str(e)}'
+            debug.print(error_msg)
+            self.report(f'delete error: {error_msg}')
+            return False
+
+    def _cmd_coderun(self, dataArgs):
+        # coderun <hash>: 執行 code 指令已編譯過的程式片段，不需再送原始碼
+        # cache 中沒有時回傳 err 'cache miss'，host 改用 code 重送原始碼
+        import json
+        key = dataArgs[1] if len(dataArgs) > 1 else ''
+        entry = Board.code_cache.get(key)
+        if entry is None:
+            response = {'state': False, 'err': 'cache miss', 'output': '', 'hash': key}
+        else:
+            response = self._exec(entry[0], key)
+        self.report('code ' + json.dumps(response))
+        # 與 code 相同，#AFTER_RESTART 開頭的程式片段執行成功後重啟
+        if response['state'] and entry[1]:
+            uasyncio.create_task(self._delayed_reset(2))
+        return response['state']
+
+    def _exec(self, compiled, key):
+        # 執行程式片段，print 輸出由 OutputCapture 以 code output <exec> <seq> 分批送出，
+        # 最後一段放在回應的 output，chunks 為之前送出的段數
+        global _EXECUTING_CODE
+        _EXECUTING_CODE = True
+        capture = Board.capture = OutputCapture(self)
+        response = {'state': True, 'err': '', 'output': '', 'hash': key, 'exec': capture.id}
+        try:
+            exec(compiled)
+        except Exception as e:
+            debug.print("Code execution error:", str(e))
+            response['state'] = False
+            response['err'] = str(e)
+        finally:
+            _EXECUTING_CODE = False
+            Board.capture = None
+        response['output'] = capture.rest()
+        response['chunks'] = capture.seq
+        if capture.truncated:
+            response['truncated'] = capture.truncated
+        return response
+
+    def _cmd_ota(self, dataArgs):
+        # ota begin <json> / file <index> / commit / status / abort / rollback
+        import json
+        op = dataArgs[1] if len(dataArgs) > 1 else 'status'
+        try:
+            if op == 'begin':
+                OTA.begin(json.loads(' '.join(dataArgs[2:])))
+                self.report(f"ota begin {len(OTA.state['files'])}")
+            elif op == 'file':
+                return OTA.startFile(self, dataArgs)
+            elif op == 'commit':
+                err = OTA.commit()
+                if err:
+                    self.report(f'ota error {err}')
+                    return False
+                self.report('ota commit')
+                # 檔案已經替換，重啟不受 max_running 限制
+                uasyncio.create_task(self._cmd_reboot(dataArgs))
+            elif op == 'abort':
+                OTA.abort()
+                self.report('ota abort')
+            elif op == 'rollback':
+                err = OTA.rollback()
+                if err:
+                    self.report(f'ota error {err}')
+                    return False
+                self.report('ota rollback')
+                uasyncio.create_task(self._cmd_reboot(dataArgs))
+            else:
+                self.report('ota ' + json.dumps(OTA.status()))
+        except Exception as e:
+            self.report(f'ota error {str(e)}')
+            return False
+
+    def _cmd_batch(self, dataArgs):
+        # batch ["<cmd>", "<cmd>", ...]: 依序執行多個指令 (JSON 字串陣列，可包含多行 code)，
+        # 所有回覆合併成一則
+        # batch [{"cmd": ..., "status": ok|error|async|unknown, "reply": [...]}, ...]
+        # async 指令 (例如 reboot) 另外以 task 執行，回覆不會出現在 batch 中
+        import json
+        try:
+            lines = json.loads(' '.join(dataArgs[1:]))
+            if not isinstance(lines, list):
+                raise ValueError('expect a JSON array of commands')
+        except ValueError as e:
+            self.report(f'batch error {str(e)}')
+            return False
+        results = []
+        for line in lines:
+            args = str(line).split(' ')
+            cmd = args[0]
+            item = {'cmd': cmd, 'status': 'ok', 'reply': []}
+            results.append(item)
+            handler = self.commands.get(cmd)
+            if handler is None or cmd == 'batch':
+                item['status'] = 'unknown'
+                continue
+            start = time.ticks_ms()
+            self._replies = item['reply']
+            try:
+                result = handler(self, args)
+                if hasattr(result, 'send'):
+                    item['status'] = 'async' if self._spawn(cmd, result, start) else 'error'
+                    continue
+                if result is False:
+                    item['status'] = 'error'
+            except Exception as e:
+                item['status'] = 'error'
+                item['reply'].append(str(e))
+            finally:
+                self._replies = None
+            self._cmdDone(cmd, start)
+        self.report('batch ' + json.dumps(results))
 
     async def _delayed_reset(self, delay_seconds):
         """非同步延遲重啟函數"""
         await uasyncio.sleep(delay_seconds)
-        machine.reset()
\ No newline at end of file
+        machine.reset()
+
+    # 指令名稱 -> handler，應用程式可用 Board.registerCmd 增加自己的指令
+    commands = {
+        'reboot': _cmd_reboot,
+        'ping': _cmd_ping,
+        'stats': _cmd_stats,
+        'info': _cmd_info,
+        'code': _cmd_code,
+        'coderun': _cmd_coderun,
+        'read': _cmd_read,
+        'hashes': _cmd_hashes,
+        'list': _cmd_list,
+        'save': _cmd_save,
+        'time': _cmd_time,
+        'delete': _cmd_delete,
+        'batch': _cmd_batch,
+        'ota': _cmd_ota,
+    }
\ No newline at end of file
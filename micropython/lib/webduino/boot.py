@@ -1,4 +1,11 @@
 #####################
+try:
+    # 完成中斷的 OTA 替換，新版本 trial 時啟動 WDT
+    from webduino.ota import OTA
+    OTA.boot()
+except Exception as e:
+    print("ota boot:", e)
+#####################
 try:
     import cmd
     print("import cmd....")
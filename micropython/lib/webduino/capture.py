@@ -0,0 +1,80 @@
+import time
+
+
+class OutputCapture:
+    """code 指令執行期間收集 print 的輸出，分批回傳給 host
+
+    輸出先放進固定大小的 buffer，buffer 滿了或距離上次送出超過 interval_ms
+    時發布 code output <execId> <seq> <text>，總量超過 max_bytes 的部分只計數
+    exec 執行中 event loop 停住，送出時直接 flush_now，長時間執行的程式也能即時看到輸出
+    """
+    chunk_size = 512
+    max_bytes = 8192
+    interval_ms = 500
+    _next_id = 0
+
+    def __init__(self, board):
+        self.board = board
+        self.buf = bytearray(OutputCapture.chunk_size)
+        self.fill = 0
+        self.seq = 0        # 已送出的 chunk 數
+        self.total = 0
+        self.truncated = 0  # 超過 max_bytes 被丟棄的 bytes
+        self.last = time.ticks_ms()
+        self.flushing = False  # 發布中，這段期間的 print 不收集
+        OutputCapture._next_id = (OutputCapture._next_id + 1) & 0xffff
+        self.id = OutputCapture._next_id
+
+    @staticmethod
+    def _boundary(data, k):
+        # 往前找到 utf-8 字元的開頭，chunk 不會切在多 byte 字元中間
+        while k > 0 and k < len(data) and data[k] & 0xc0 == 0x80:
+            k -= 1
+        return k
+
+    def print(self, args, kwargs):
+        self.write(kwargs.get('sep', ' ').join(map(str, args)) + kwargs.get('end', '\n'))
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        room = OutputCapture.max_bytes - self.total
+        n = len(data)
+        if n > room:
+            n = OutputCapture._boundary(data, room)
+            self.truncated += len(data) - n
+        self.total += n
+        pos = 0
+        while pos < n:
+            k = min(n - pos, OutputCapture.chunk_size - self.fill)
+            if pos + k < n:
+                k = OutputCapture._boundary(data, pos + k) - pos
+            if k > 0:
+                self.buf[self.fill:self.fill + k] = data[pos:pos + k]
+                self.fill += k
+                pos += k
+            if pos < n:
+                self.flush()
+        if self.fill and time.ticks_diff(time.ticks_ms(), self.last) >= OutputCapture.interval_ms:
+            self.flush()
+
+    def flush(self):
+        board = self.board
+        if self.fill and not self.flushing:
+            # 先複製資料並清空 buffer 再發布，發布過程中函式庫自己的 print (例如 debug 訊息)
+            # 不會被收集，也不會重入 flush 重複送出同一段
+            data = b'code output %d %d ' % (self.id, self.seq) + self.buf[:self.fill]
+            self.seq += 1
+            self.fill = 0
+            self.flushing = True
+            try:
+                board.mqtt.pub(board.topic_ack, data)
+                board.mqtt.flush_now()
+            finally:
+                self.flushing = False
+        self.last = time.ticks_ms()
+
+    def rest(self):
+        # 尚未送出的輸出，放在 code 指令最後的回應中
+        text = bytes(self.buf[:self.fill]).decode('utf-8')
+        self.fill = 0
+        return text
@@ -0,0 +1,57 @@
+import ubinascii, uhashlib
+
+
+class CodeCache:
+    """code 指令編譯結果的 LRU cache，key 為原始碼 sha256 的前 16 個 hex 字元
+
+    同樣的程式片段再次執行時不需重新 compile，host 也可以只送 key (coderun)
+    每筆為 (code object, restart)，restart 表示原始碼以 #AFTER_RESTART 開頭，執行後要重啟
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self.codes = {}   # key -> (code object, restart)
+        self.order = []   # 最近使用的 key 在最後
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source):
+        return ubinascii.hexlify(uhashlib.sha256(source.encode('utf-8')).digest()).decode()[:16]
+
+    def get(self, key):
+        code = self.codes.get(key)
+        if code is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.order[-1] != key:
+            self.order.remove(key)
+            self.order.append(key)
+        return code
+
+    def put(self, key, entry):
+        if key in self.codes:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.codes[self.order.pop(0)]
+        self.codes[key] = entry
+        self.order.append(key)
+
+    def compile(self, source):
+        # 回傳 (key, (code object, restart))，沒有 compile() 的韌體直接回傳原始碼給 exec
+        key = CodeCache.key(source)
+        entry = self.get(key)
+        if entry is None:
+            try:
+                code = compile(source, '<code>', 'exec')
+            except NameError:
+                code = source
+            entry = (code, source.startswith('#AFTER_RESTART'))
+            self.put(key, entry)
+        return key, entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.codes), 'max': self.size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0}
@@ -0,0 +1,96 @@
+import os, struct
+from webduino.debug import debug
+
+
+class Journal:
+    """離線時暫存 MQTT 發布資料的 append-only 檔案
+
+    每筆紀錄: flags(1) topicLen(2) msgLen(2) topic msg (little endian)
+    flags bit0 = retain, bit1-2 = qos
+    檔案超過 max_bytes 時新的紀錄會被丟棄
+    """
+    HEADER = '<BHH'
+    HEADER_SIZE = 5
+
+    def __init__(self, filename='mqtt.journal', max_bytes=32768):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.f = None
+        self.offset = 0   # replay 讀取位置
+        self.dropped = 0
+        self.written = 0
+        self.replayed = 0
+        try:
+            self.size = os.stat(filename)[6]
+        except OSError:
+            self.size = 0
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def append(self, topic, msg, retain=False, qos=0):
+        if isinstance(topic, str):
+            topic = topic.encode('utf-8')
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        rec_size = Journal.HEADER_SIZE + len(topic) + len(msg)
+        if self.size + rec_size > self.max_bytes:
+            self.dropped += 1
+            return False
+        try:
+            if self.f is None:
+                self.f = open(self.filename, 'ab')
+            self.f.write(struct.pack(Journal.HEADER, (1 if retain else 0) | qos << 1, len(topic), len(msg)))
+            self.f.write(topic)
+            self.f.write(msg)
+            self.f.flush()
+        except OSError as e:
+            debug.DEBUG(f"Journal write error: {str(e)}")
+            self.dropped += 1
+            return False
+        self.size += rec_size
+        self.written += 1
+        return True
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def read(self, count):
+        # 從 offset 開始讀出最多 count 筆 [(topic, msg, retain, qos), ...]
+        self.close()
+        records = []
+        if self.offset >= self.size:
+            return records
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            hdr = bytearray(Journal.HEADER_SIZE)
+            while len(records) < count and self.offset < self.size:
+                if f.readinto(hdr) != Journal.HEADER_SIZE:
+                    self.offset = self.size  # 紀錄不完整，丟棄剩下的部分
+                    break
+                flags, tlen, mlen = struct.unpack(Journal.HEADER, hdr)
+                topic = f.read(tlen).decode('utf-8')
+                msg = f.read(mlen)
+                self.offset += Journal.HEADER_SIZE + tlen + mlen
+                records.append((topic, msg, bool(flags & 1), (flags >> 1) & 0x03))
+        return records
+
+    def ack(self, count):
+        self.replayed += count
+        if self.offset >= self.size:
+            self.clear()
+
+    def clear(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        self.size = 0
+        self.offset = 0
+
+    def stats(self):
+        return {'bytes': self.size - self.offset, 'written': self.written,
+                'replayed': self.replayed, 'dropped': self.dropped}
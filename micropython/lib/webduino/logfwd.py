@@ -0,0 +1,83 @@
+import time, uasyncio
+from webduino.ringbuf import RingQueue
+
+
+class LogForwarder:
+    """把 ! 開頭的 print 與 log() 的內容集中成一則 MQTT 訊息送出
+
+    每一行先放進固定大小的 RingQueue，滿了、累積超過 max_bytes 或最舊的一行
+    等待超過 flush_ms 時才合併成一則訊息 (以換行分隔) 發布到 topic
+    離線時保留在 ring 中，滿了丟掉最舊的行，重新連線後送出並附上丟棄的行數
+    level 與 debug.level 相同: 1 ERROR / 2 WARN / 3 INFO / 4 DEBUG，
+    超過 level 的呼叫在組字串之前就返回
+    """
+    ERROR = 1
+    WARN = 2
+    INFO = 3
+    DEBUG = 4
+    level = 3
+    flush_ms = 1000
+    max_bytes = 1024
+    mqtt = None
+    topic = None
+    _lines = RingQueue(32, RingQueue.DROP_OLDEST)
+    _bytes = 0
+    _first = 0       # ring 中最舊一行的時間
+    _reported = 0    # 已回報過的丟棄行數
+    _task = None
+    stats = {'lines': 0, 'messages': 0, 'filtered': 0}
+
+    @staticmethod
+    def setup(mqtt, topic, size=32, level=3):
+        LogForwarder.mqtt = mqtt
+        LogForwarder.topic = topic
+        LogForwarder.level = level
+        if size != LogForwarder._lines.size:
+            LogForwarder._lines = RingQueue(size, RingQueue.DROP_OLDEST)
+
+    @staticmethod
+    def log(level, args):
+        if level > LogForwarder.level:
+            LogForwarder.stats['filtered'] += 1
+            return
+        line = ' '.join(map(str, args))
+        lines = LogForwarder._lines
+        if len(lines) == 0:
+            LogForwarder._first = time.ticks_ms()
+        elif lines.full():
+            LogForwarder._bytes -= len(lines.peek()) + 1
+        lines.put(line)
+        LogForwarder._bytes += len(line) + 1
+        LogForwarder.stats['lines'] += 1
+        if lines.full() or LogForwarder._bytes >= LogForwarder.max_bytes:
+            LogForwarder.flush()
+        elif LogForwarder._task is None:
+            try:
+                LogForwarder._task = uasyncio.create_task(LogForwarder._flush_loop())
+            except RuntimeError:
+                pass  # event loop 尚未啟動，等 ring 滿了再送
+
+    @staticmethod
+    def flush():
+        lines = LogForwarder._lines
+        mqtt = LogForwarder.mqtt
+        if len(lines) == 0 or mqtt is None or LogForwarder.topic is None or not mqtt.connected:
+            return False
+        out = []
+        dropped = lines.dropped - LogForwarder._reported
+        if dropped:
+            out.append(f'[log] {dropped} lines dropped')
+            LogForwarder._reported = lines.dropped
+        while len(lines):
+            out.append(lines.get())
+        LogForwarder._bytes = 0
+        mqtt.pub(LogForwarder.topic, '\n'.join(out))
+        LogForwarder.stats['messages'] += 1
+        return True
+
+    @staticmethod
+    async def _flush_loop():
+        while True:
+            await uasyncio.sleep_ms(LogForwarder.flush_ms // 2)
+            if len(LogForwarder._lines) and time.ticks_diff(time.ticks_ms(), LogForwarder._first) >= LogForwarder.flush_ms:
+                LogForwarder.flush()
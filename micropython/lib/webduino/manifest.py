@@ -0,0 +1,209 @@
+import os, json, uasyncio, ubinascii, uhashlib
+from webduino.debug import debug
+
+
+class Manifest:
+    """檔案清單索引: path -> [size, mtime, sha256 前 16 字元]
+
+    第一次使用時掃描整個檔案系統並存到 manifest.json，之後由 save / delete
+    逐筆更新，list 的遞迴查詢直接從索引分頁回傳，不需要每個檔案 os.stat
+    path 一律不含開頭的 /
+    """
+    filename = 'manifest.json'
+    save_delay_ms = 1000   # 連續更新時合併成一次寫入
+    # 函式庫自己的狀態檔 / 目錄 (OTA staging 與備份、離線 journal) 不列入索引
+    internal = ('manifest.json', 'ota.json', 'mqtt.journal')
+    internal_dirs = ('ota/', 'ota.bak/')
+    entries = None
+    listeners = []         # fn(path)，檔案被 save / delete 時呼叫 (例如 info 的 cache)
+    _keys = None           # 排序後的 path，分頁查詢用
+    _save_task = None
+    _rebuild_task = None
+    _dirty = None          # 重新掃描期間被 save / delete 的 path，掃描完再更新
+
+    @staticmethod
+    def load():
+        # 讀取索引檔，沒有索引檔時回傳 None (由 ready() 在背景掃描建立)
+        if Manifest.entries is None:
+            try:
+                with open(Manifest.filename, 'r') as f:
+                    Manifest.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return Manifest.entries
+
+    @staticmethod
+    async def ready():
+        # 等待索引可用，第一次使用時掃描整個檔案系統
+        if Manifest.load() is None:
+            Manifest.rebuild()
+        task = Manifest._rebuild_task
+        if task is not None:
+            await task
+        return Manifest.entries
+
+    @staticmethod
+    def rebuild():
+        # 以 task 掃描，每個檔案 / 每 8 KB 讓出 CPU，MQTT 接收與 keepalive 不會停住
+        if Manifest._rebuild_task is None:
+            Manifest._rebuild_task = uasyncio.create_task(Manifest._rebuild())
+        return Manifest._rebuild_task
+
+    @staticmethod
+    async def _rebuild():
+        entries = {}
+        Manifest._dirty = set()
+        try:
+            await Manifest._scan('', entries)
+            # 掃描期間變動的檔案重新確認
+            for path in Manifest._dirty:
+                prefix = path + '/'
+                for key in [k for k in entries if k == path or k.startswith(prefix)]:
+                    del entries[key]
+                try:
+                    entries[path] = Manifest._entry(path)
+                except OSError:
+                    pass
+            Manifest.entries = entries
+            Manifest._keys = None
+            Manifest.save()
+            debug.print(f"manifest rebuilt: {len(entries)} files")
+        finally:
+            Manifest._dirty = None
+            Manifest._rebuild_task = None
+
+    @staticmethod
+    async def _scan(path, entries):
+        for entry in list(os.ilistdir('/' + path if path else '/')):
+            name = path + entry[0]
+            if entry[1] == 0x4000:
+                if name + '/' not in Manifest.internal_dirs:
+                    await Manifest._scan(name + '/', entries)
+            elif not Manifest._skip(name):
+                st = os.stat(name)
+                entries[name] = [st[6], st[8], (await Manifest._hash(name))[:16]]
+
+    @staticmethod
+    async def _hash(path):
+        sha = uhashlib.sha256()
+        buf = bytearray(512)
+        mv = memoryview(buf)
+        n = 0
+        with open(path, 'rb') as f:
+            while True:
+                k = f.readinto(buf)
+                if not k:
+                    break
+                sha.update(mv[:k])
+                n += 1
+                if n & 15 == 0:
+                    await uasyncio.sleep_ms(0)
+        await uasyncio.sleep_ms(0)
+        return ubinascii.hexlify(sha.digest()).decode()
+
+    @staticmethod
+    def _skip(path):
+        if path in Manifest.internal or path.endswith('.tmp'):
+            return True
+        for d in Manifest.internal_dirs:
+            if path.startswith(d):
+                return True
+        return False
+
+    @staticmethod
+    def _entry(path, digest=None):
+        st = os.stat(path)
+        if digest is None:
+            sha = uhashlib.sha256()
+            buf = bytearray(512)
+            mv = memoryview(buf)
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    sha.update(mv[:n])
+            digest = ubinascii.hexlify(sha.digest()).decode()
+        return [st[6], st[8], digest[:16]]
+
+    @staticmethod
+    def _loaded():
+        # 還沒有索引檔時不需要更新，之後第一次查詢時會重新掃描
+        return Manifest.load() is not None
+
+    @staticmethod
+    def normalize(path):
+        return path.strip('/')
+
+    @staticmethod
+    def update(path, digest=None):
+        # save 完成後呼叫，digest 為已知的 sha256 (hex) 時不需重新讀檔
+        Manifest._notify(path)
+        path = Manifest.normalize(path)
+        if Manifest._skip(path):
+            return
+        if Manifest._dirty is not None:
+            Manifest._dirty.add(path)
+        if not Manifest._loaded():
+            return
+        try:
+            Manifest.entries[path] = Manifest._entry(path, digest)
+        except OSError:
+            Manifest.entries.pop(path, None)
+        Manifest._changed()
+
+    @staticmethod
+    def remove(path):
+        # 刪除檔案或目錄 (目錄底下的項目一起移除)
+        Manifest._notify(path)
+        path = Manifest.normalize(path)
+        if Manifest._dirty is not None:
+            Manifest._dirty.add(path)
+        if not Manifest._loaded():
+            return
+        prefix = path + '/'
+        for key in [k for k in Manifest.entries if k == path or k.startswith(prefix)]:
+            del Manifest.entries[key]
+        Manifest._changed()
+
+    @staticmethod
+    def _notify(path):
+        for fn in Manifest.listeners:
+            fn(path)
+
+    @staticmethod
+    def _changed():
+        Manifest._keys = None
+        if Manifest._save_task is None:
+            Manifest._save_task = uasyncio.create_task(Manifest._save_later())
+
+    @staticmethod
+    async def _save_later():
+        await uasyncio.sleep_ms(Manifest.save_delay_ms)
+        Manifest._save_task = None
+        Manifest.save()
+
+    @staticmethod
+    def save():
+        try:
+            with open(Manifest.filename, 'w') as f:
+                json.dump(Manifest.entries, f)
+        except OSError as e:
+            debug.print(f"manifest save error: {str(e)}")
+
+    @staticmethod
+    def page(path='', page=0, size=50):
+        # 回傳 path 底下 (遞迴) 第 page 頁的 [[path, size, mtime, hash], ...]
+        # 呼叫前先 await ready()
+        entries = Manifest.entries
+        if Manifest._keys is None:
+            Manifest._keys = sorted(entries)
+        prefix = Manifest.normalize(path)
+        keys = Manifest._keys
+        if prefix:
+            prefix += '/'
+            keys = [k for k in keys if k.startswith(prefix)]
+        total = len(keys)
+        files = [[k] + entries[k] for k in keys[page * size:(page + 1) * size]]
+        return {'path': '/' + prefix, 'page': page, 'pages': (total + size - 1) // size,
+                'total': total, 'files': files}
@@ -0,0 +1,65 @@
+from array import array
+
+
+class TopicMetrics:
+    """每個 topic 的訊息數 / bytes / callback 時間分佈 / 佇列等待時間
+
+    所有計數都放在預先配置的 array 中，record() 不會配置新的記憶體，
+    新 topic 第一次出現時才佔用一個 slot，超過 slots 的 topic 併入最後一個 slot
+    histogram 第 i 格代表 callback 時間 < 2**i ms，最後一格為更長的時間
+    """
+    BUCKETS = 10
+
+    def __init__(self, slots=16):
+        self.slots = slots
+        self.index = {}  # topic -> slot
+        self.count = array('I', [0] * slots)
+        self.bytes = array('I', [0] * slots)
+        self.hist = array('I', [0] * (slots * TopicMetrics.BUCKETS))
+        self.waitTotal = array('I', [0] * slots)
+        self.waitMax = array('I', [0] * slots)
+        self.depthMax = array('H', [0] * slots)
+
+    def slot(self, topic):
+        i = self.index.get(topic)
+        if i is None:
+            if len(self.index) < self.slots - 1:
+                i = self.index[topic] = len(self.index)
+            else:
+                i = self.slots - 1  # 其他 topic
+        return i
+
+    def record(self, topic, size, duration, wait=0, depth=0):
+        i = self.slot(topic)
+        self.count[i] += 1
+        self.bytes[i] += size
+        b = 0
+        while duration > 0 and b < TopicMetrics.BUCKETS - 1:
+            duration >>= 1
+            b += 1
+        self.hist[i * TopicMetrics.BUCKETS + b] += 1
+        self.waitTotal[i] += wait
+        if wait > self.waitMax[i]:
+            self.waitMax[i] = wait
+        if depth > self.depthMax[i]:
+            self.depthMax[i] = depth
+
+    def reset(self):
+        for arr in (self.count, self.bytes, self.hist, self.waitTotal, self.waitMax, self.depthMax):
+            for i in range(len(arr)):
+                arr[i] = 0
+
+    def summary(self):
+        # 精簡格式: {topic: [count, bytes, waitAvg, waitMax, depthMax, [hist...]]}
+        result = {}
+        names = list(self.index.items())
+        if len(self.index) >= self.slots - 1:
+            names.append(('*', self.slots - 1))
+        for topic, i in names:
+            n = self.count[i]
+            if n == 0:
+                continue
+            base = i * TopicMetrics.BUCKETS
+            result[topic] = [n, self.bytes[i], self.waitTotal[i] // n, self.waitMax[i],
+                             self.depthMax[i], list(self.hist[base:base + TopicMetrics.BUCKETS])]
+        return result
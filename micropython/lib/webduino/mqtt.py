@@ -1,77 +1,547 @@
-import network, ubinascii, machine, uasyncio, time
-from umqtt.robust import MQTTClient
+import network, ubinascii, machine, uasyncio, time, random
+from webduino.amqtt import AsyncMQTTClient
 from webduino.debug import debug
+from webduino.ringbuf import RingQueue
+from webduino.topictrie import TopicTrie
+from webduino.metrics import TopicMetrics
+from webduino.journal import Journal
 
 class MQTT:
-    _callbacks = {}
-    _sub_queue = []  # 新增訂閱資料隊列
-    _pub_queue = []  # 新增發布資料隊列
+    _callbacks = {}  # topic filter -> callback，重新訂閱時使用
+    _sub_qos = {}    # topic filter -> qos
+    _subscribed = {} # broker 已確認 (SUBACK) 的 topic filter -> qos
+    clean_session = True
+    _topics = TopicTrie()  # 支援 + / # 萬用字元的分派表
+    # 收到的 topic (bytes) -> (topic str, callbacks, priority)，避免每筆訊息都 decode / 比對
+    _routes = {}
+    route_cache_size = 32
+    _interned = {}  # 發布用 topic str -> bytes
+    PRIO_HIGH = 0    # 裝置指令 (<devId>-cmd)
+    PRIO_NORMAL = 1
+    PRIO_LOW = 2     # 大量遙測 / 遊戲資料
+    # 訂閱資料環形佇列，每個優先等級一條，數字小的先處理
+    _lanes = [RingQueue(8, RingQueue.DROP_OLDEST),
+              RingQueue(32, RingQueue.DROP_OLDEST),
+              RingQueue(32, RingQueue.DROP_OLDEST)]
+    lane_stats = [[0, 0, 0], [0, 0, 0], [0, 0, 0]]  # 每條 lane: [count, waitTotal, waitMax]
+    metrics = TopicMetrics()  # 每個 topic 的處理時間統計
+    _pub_queue = RingQueue(32, RingQueue.DROP_OLDEST)  # 發布資料環形佇列
+    _pub_policy = {}  # topic -> 'drop' / 'block'，佇列滿時的處理方式
+    _pub_event = None
+    _pub_task = None
+    _sub_event = None
+    _run_task = None
+    client = None
+    port = 1883
+    pub_batch = 8   # 每批最多送出幾筆
+    pub_stats = {'queued': 0, 'sent': 0, 'errors': 0, 'blocked': 0, 'offline_dropped': 0,
+                 'coalesced': 0, 'suppressed': 0}
+    _coalesce = {}  # topic -> [deadband, 上次發布的數值]
+    _pending = {}   # topic -> 仍在發布佇列中的資料 (list)，新值直接覆蓋
+    _offline_policy = {}  # topic -> 'journal' / 'drop'，離線時的處理方式 (預設留在記憶體佇列)
+    journal = None
+    replay_batch = 10          # 重連後每批從 journal 補送幾筆
+    replay_interval_ms = 200   # 每批之間的間隔，避免重連瞬間塞滿連線
+    _replay_task = None
     wdt = None  # 初始化 wdt 屬性為 None
     last_callback_log_time = None # 記錄上次 callback log 的時間點
+    budget_ms = 20  # 每次 checkMsg 處理訂閱訊息的時間預算
+    connected = False
+    reconnect_base_ms = 1000   # 第一次重連等待時間，之後指數增加
+    reconnect_max_ms = 60000
+    failure_budget = 10        # 連續重連失敗超過此次數才重啟設備
+    _failures = 0
+    _next_retry = 0
+    _down_since = None
+    reconnect_stats = {'reconnects': 0, 'failures': 0, 'cb_errors': 0,
+                       'last_recover_ms': 0, 'max_recover_ms': 0,
+                       'session_resumed': 0}
 
     @staticmethod
-    def connect(user='webduino', pwd='webduino'):
-        MQTT.now = 0
+    def set_sub_queue(size=32, policy=RingQueue.DROP_OLDEST, budget_ms=20, high_size=8):
+        # 重新設定訂閱佇列容量 / 滿載策略 / 每次處理的時間預算
+        MQTT._lanes = [RingQueue(high_size, policy), RingQueue(size, policy), RingQueue(size, policy)]
+        MQTT.budget_ms = budget_ms
+
+    @staticmethod
+    def pending():
+        n = 0
+        for lane in MQTT._lanes:
+            n += len(lane)
+        return n
+
+    @staticmethod
+    def set_pub_queue(size=32, batch=8):
+        MQTT._pub_queue = RingQueue(size, RingQueue.DROP_OLDEST)
+        MQTT.pub_batch = batch
+
+    @staticmethod
+    def set_pub_policy(topic, policy='drop'):
+        # drop: 佇列滿時丟掉最舊的發布, block: 佇列滿時同步送出騰出空間，
+        # 其他 topic 把佇列塞滿時也不會丟掉 block topic 的資料
+        for t in MQTT._topic_keys(topic):
+            MQTT._pub_policy[t] = policy
+
+    @staticmethod
+    def _topic_keys(topic):
+        # 發布 topic 可能是 str 或 intern() 後的 bytes，設定時兩種都登記
+        if isinstance(topic, bytes):
+            return (topic, topic.decode('utf-8'))
+        return (topic, MQTT.intern(topic))
+
+    @staticmethod
+    def set_coalesce(topic, deadband=None):
+        # 佇列中還有同 topic 尚未送出的資料時，新值直接取代舊值，每次只送最新的值
+        # deadband: 數值變化不超過此值時不發布
+        coalesce = [deadband, None]
+        for t in MQTT._topic_keys(topic):
+            MQTT._coalesce[t] = coalesce
+
+    @staticmethod
+    def set_offline_policy(topic, policy='journal', max_bytes=32768):
+        # journal: 離線時寫入 flash，重連後補送; drop: 離線時直接丟棄
+        for t in MQTT._topic_keys(topic):
+            MQTT._offline_policy[t] = policy
+        if policy == 'journal' and MQTT.journal is None:
+            MQTT.journal = Journal('mqtt.journal', max_bytes)
+
+    @staticmethod
+    def queue_stats():
+        pub = MQTT._pub_queue.stats()
+        pub.update(MQTT.pub_stats)
+        lanes = []
+        for lane, (n, wait_total, wait_max) in zip(MQTT._lanes, MQTT.lane_stats):
+            st = lane.stats()
+            st['count'] = n
+            st['waitAvg'] = wait_total // n if n else 0
+            st['waitMax'] = wait_max
+            lanes.append(st)
+        stats = {'sub': lanes, 'pub': pub}
+        if MQTT.client:
+            qos = dict(MQTT.client.qos_stats)
+            qos['inflight'] = len(MQTT.client.inflight)
+            stats['qos1'] = qos
+        if MQTT.journal:
+            stats['journal'] = MQTT.journal.stats()
+        return stats
+
+    @staticmethod
+    def connect(user='webduino', pwd='webduino', clean_session=True):
+        # 只建立 client，實際連線 / 重連由背景 _run 任務處理
+        # clean_session=False 時使用 MAC 產生的固定 client id 保留 broker 端 session，
+        # 重連時若 broker 回報 session present 就不必重新訂閱
+        MQTT.clean_session = clean_session
         MQTT.user = user
         MQTT.pwd = pwd
         MQTT.keepalive = 60
         mac = ubinascii.hexlify(network.WLAN().config('mac'), ':').decode().replace(':', '')
-        MQTT.client = MQTTClient('wa'+mac, MQTT.server, user=user, password=pwd, keepalive=MQTT.keepalive)
+        if MQTT.client:
+            MQTT.client.close()
+        MQTT.client = AsyncMQTTClient('wa'+mac, MQTT.server, MQTT.port, user=user, password=pwd,
+                                      keepalive=MQTT.keepalive, clean_session=clean_session)
+        MQTT.client.set_callback(MQTT._safe_callback)
         MQTT.set_last_will(MQTT.topic_report, MQTT.topic_report_msg)
-        try:
-            MQTT.client.connect()
-            state = True
-        except Exception as e:
-            debug.DEBUG("Error connecting using robust client: " + str(e))
+        MQTT._next_retry = time.ticks_ms()
+        MQTT.start_tasks()
+
+    @staticmethod
+    async def _run():
+        while True:
+            wait = time.ticks_diff(MQTT._next_retry, time.ticks_ms())
+            if wait > 0:
+                await uasyncio.sleep_ms(wait)
+            client = MQTT.client
+            try:
+                session_present = await client.connect()
+            except Exception as e:
+                client.close()
+                MQTT._fail(e)
+                continue
+            MQTT.connected = True
+            # SUBACK 由 run() 讀取，必須先開始接收才能等待訂閱結果
+            reader = uasyncio.create_task(client.run())
+            error = None
+            try:
+                client.resend_inflight()
+                await MQTT._resubscribe(session_present)
+                MQTT._recovered()
+                MQTT._start_replay()
+            except Exception as e:
+                error = e
+                client.close()
+            try:
+                await reader
+            except Exception as e:
+                MQTT._fail(error or e)
+
+    @staticmethod
+    def _fail(e):
+        # 連線中斷：記錄狀態，以指數退避 + 隨機抖動安排下一次重連
+        if MQTT.connected or MQTT._down_since is None:
+            MQTT._down_since = time.ticks_ms()
+        MQTT.connected = False
+        MQTT._failures += 1
+        MQTT.reconnect_stats['failures'] += 1
+        if MQTT._failures > MQTT.failure_budget:
+            debug.DEBUG(f"MQTT reconnect failed {MQTT._failures} times, reset...")
             machine.reset()
+        delay = min(MQTT.reconnect_max_ms, MQTT.reconnect_base_ms << min(MQTT._failures - 1, 16))
+        delay = delay // 2 + random.getrandbits(16) % (delay // 2 + 1)
+        MQTT._next_retry = time.ticks_add(time.ticks_ms(), delay)
+        debug.DEBUG(f"MQTT broken: {str(e)}, retry in {delay} ms")
+
+    @staticmethod
+    def _recovered():
+        if MQTT._down_since is not None:
+            recover = time.ticks_diff(time.ticks_ms(), MQTT._down_since)
+            stats = MQTT.reconnect_stats
+            stats['reconnects'] += 1
+            stats['last_recover_ms'] = recover
+            if recover > stats['max_recover_ms']:
+                stats['max_recover_ms'] = recover
+            debug.DEBUG(f"MQTT reconnected in {recover} ms")
+        MQTT._failures = 0
+        MQTT._down_since = None
+        if MQTT._pub_event:
+            MQTT._pub_event.set()
 
     @staticmethod
-    def pub(topic, msg, retain=False):
+    async def _resubscribe(session_present=False):
+        if session_present:
+            MQTT.reconnect_stats['session_resumed'] += 1
+        else:
+            MQTT._subscribed.clear()
+        # session 仍在時只補訂閱 broker 尚未確認的 topic
+        topics = [(t, MQTT._sub_qos.get(t, 0)) for t in MQTT._callbacks
+                  if MQTT._subscribed.get(t) != MQTT._sub_qos.get(t, 0)]
+        if topics:
+            await MQTT.client.subscribe(topics)
+            for t, qos in topics:
+                MQTT._subscribed[t] = qos
+            debug.DEBUG(f"Resubscribed to topics: {topics}")
+
+    @staticmethod
+    def pub(topic, msg, retain=False, qos=0):
+        coalesce = MQTT._coalesce.get(topic)
+        if coalesce:
+            if coalesce[0] is not None:
+                try:
+                    value = float(msg)
+                except (ValueError, TypeError):
+                    value = None
+                if value is not None:
+                    if coalesce[1] is not None and abs(value - coalesce[1]) <= coalesce[0]:
+                        MQTT.pub_stats['suppressed'] += 1
+                        return
+                    coalesce[1] = value
+            item = MQTT._pending.get(topic)
+            if item is not None:
+                item[1] = msg
+                item[2] = retain
+                MQTT.pub_stats['coalesced'] += 1
+                return
+        if not MQTT.connected:
+            policy = MQTT._offline_policy.get(topic)
+            if policy == 'journal':
+                MQTT.journal.append(topic, msg, retain, qos)
+                return
+            if policy == 'drop':
+                MQTT.pub_stats['offline_dropped'] += 1
+                return
+        queue = MQTT._pub_queue
+        if not isinstance(msg, (str, bytes)):
+            # bytearray / memoryview 可能是呼叫端重複使用的 buffer
+            if MQTT.connected and len(queue) == 0 and not qos and not coalesce:
+                # 佇列是空的就直接寫入 stream (stream 會複製資料)，不需另外配置
+                try:
+                    MQTT.client.publish_nowait(topic, msg, retain=retain)
+                    MQTT.pub_stats['sent'] += 1
+                    return
+                except Exception:
+                    MQTT.pub_stats['errors'] += 1
+                    MQTT.client.close()
+            msg = bytes(msg)
+        if queue.full() and MQTT._pub_policy.get(topic) == 'block':
+            # 佇列滿了，同步送出最舊的一筆騰出空間
+            MQTT.pub_stats['blocked'] += 1
+            MQTT._send_one()
+        if queue.full():
+            # 所有 topic 共用一個佇列，丟資料時跳過 block topic (例如 ack)，
+            # 改丟其他 topic 最舊的一筆，遙測大量發布時不會擠掉 block topic 的資料
+            policy = MQTT._pub_policy
+            item = queue.drop(lambda it: policy.get(it[0]) != 'block') if policy else None
+            MQTT._forget(item if item is not None else queue.peek())  # 全部都是 block 時丟最舊的一筆
+        if coalesce:
+            item = [topic, msg, retain, qos]
+            MQTT._pending[topic] = item
+            queue.put(item)
+        else:
+            queue.put((topic, msg, retain, qos))
+        MQTT.pub_stats['queued'] += 1
+        # debug.level 預設為 4，以 debug.state 判斷 (Board 預設 debug.off())，關閉時不組字串
+        if debug.state:
+            debug.DEBUG(f"out >>>>>>>>>>>>>>> queued {topic}:{msg} [{len(queue)}]")
+        if MQTT._pub_event:
+            MQTT._pub_event.set()
+
+    @staticmethod
+    async def apub(topic, msg, retain=False, qos=0):
+        # 佇列滿時等待背景任務送出再放入，大量連續發布 (檔案傳輸) 不會被丟棄
+        while MQTT._pub_queue.full():
+            await uasyncio.sleep_ms(10)
+        MQTT.pub(topic, msg, retain, qos)
+
+    @staticmethod
+    def _send_one():
+        if not MQTT.connected:
+            return False
+        topic, msg, retain, qos = MQTT._pub_queue.peek()
+        if qos and MQTT.client.window_full():
+            return False
         try:
-            MQTT.client.publish(topic, msg, retain=retain, qos=0)
-            #MQTT._pub_queue.append((topic, msg, retain))
-            debug.DEBUG(f"out >>>>>>>>>>>>>>> queued {topic}:{msg} [{len(MQTT._pub_queue)}]")
+            MQTT.client.publish_nowait(topic, msg, retain=retain, qos=qos)
         except Exception as e:
+            MQTT.pub_stats['errors'] += 1
             debug.DEBUG(f"Queueing publish error: {str(e)}")
-            # 考慮是否在此處重置，或讓 checkMsg 中的發布失敗處理
-            # machine.reset()
+            MQTT.client.close()  # _run 任務會偵測到斷線並重連
+            return False
+        MQTT._forget(MQTT._pub_queue.get())
+        MQTT.pub_stats['sent'] += 1
+        return True
+
+    @staticmethod
+    def _forget(item):
+        # 資料離開佇列後，同 topic 的新值不能再覆蓋它
+        if MQTT._pending and MQTT._pending.get(item[0]) is item:
+            del MQTT._pending[item[0]]
+
+    @staticmethod
+    def flush_now():
+        # 同步送出佇列中全部資料，例如重啟前確保 ack 已送出
+        while len(MQTT._pub_queue) > 0:
+            if not MQTT._send_one():
+                return False
+        return True
+
+    @staticmethod
+    async def flush_pub_queue():
+        # 每批送出 pub_batch 筆，批次之間讓出 CPU 給感測 / LED 等任務
+        queue = MQTT._pub_queue
+        while len(queue) > 0:
+            for i in range(MQTT.pub_batch):
+                if len(queue) == 0:
+                    break
+                if queue.peek()[3] and MQTT.client.window_full():
+                    # QoS 1 window 已滿，等待 PUBACK 空出位置
+                    try:
+                        await MQTT.client.wait_window()
+                    except Exception:
+                        return False
+                if not MQTT._send_one():
+                    return False
+            try:
+                # 等待 socket 送出，同時讓出 CPU 給感測 / LED 等任務
+                await MQTT.client.writer.drain()
+            except Exception:
+                MQTT.pub_stats['errors'] += 1
+                MQTT.client.close()
+                return False
+        return True
+
+    @staticmethod
+    async def _pub_loop():
+        while True:
+            await MQTT._pub_event.wait()
+            MQTT._pub_event.clear()
+            if not await MQTT.flush_pub_queue():
+                # 發布失敗，稍後再試
+                await uasyncio.sleep_ms(1000)
+                MQTT._pub_event.set()
+
+    @staticmethod
+    def _start_replay():
+        if MQTT.journal and len(MQTT.journal) > 0 and MQTT._replay_task is None:
+            MQTT._replay_task = uasyncio.create_task(MQTT._replay())
+
+    @staticmethod
+    async def _replay():
+        # 依 replay_batch / replay_interval_ms 分批把 journal 送回發布佇列
+        journal = MQTT.journal
+        queue = MQTT._pub_queue
+        try:
+            while MQTT.connected and len(journal) > 0:
+                # 佇列比 replay_batch 小時也能補送，每批最多填滿佇列的空位
+                room = min(MQTT.replay_batch, queue.size - len(queue))
+                if room <= 0:
+                    await uasyncio.sleep_ms(MQTT.replay_interval_ms)
+                    continue
+                records = journal.read(room)
+                for record in records:
+                    queue.put(record)
+                journal.ack(len(records))
+                MQTT._pub_event.set()
+                await uasyncio.sleep_ms(MQTT.replay_interval_ms)
+        except Exception as e:
+            debug.DEBUG(f"Journal replay error: {str(e)}")
+        MQTT._replay_task = None
+
+    @staticmethod
+    async def _dispatch_loop():
+        # 收到訊息就處理，不需等待使用者迴圈呼叫 checkMsg
+        while True:
+            await MQTT._sub_event.wait()
+            MQTT._sub_event.clear()
+            while MQTT.pending() > 0:
+                await MQTT.process_sub_msg()
+                await uasyncio.sleep_ms(0)
+
+    @staticmethod
+    def start_tasks():
+        if MQTT._run_task is not None:
+            return
+        MQTT._pub_event = uasyncio.Event()
+        MQTT._sub_event = uasyncio.Event()
+        MQTT._run_task = uasyncio.create_task(MQTT._run())
+        MQTT._pub_task = uasyncio.create_task(MQTT._pub_loop())
+        uasyncio.create_task(MQTT._dispatch_loop())
+        if len(MQTT._pub_queue) > 0:
+            MQTT._pub_event.set()
 
     @staticmethod
     async def process_sub_msg():
-        # Process only one message from the queue per call
-        if len(MQTT._sub_queue) > 0:
-            if MQTT.wdt: MQTT.wdt.feed()
-            topic, msg, retain = MQTT._sub_queue.pop(0)
+        # 在 budget_ms 時間內盡量處理佇列中的訊息，至少處理一筆
+        # 每處理一筆都從最高優先的 lane 開始找，指令不會被遙測資料擋住
+        lanes = MQTT._lanes
+        if MQTT.pending() == 0:
+            return
+        if MQTT.wdt: MQTT.wdt.feed()
+        budget_start = time.ticks_ms()
+        while True:
+            prio = 0
+            for queue in lanes:
+                if len(queue) > 0:
+                    break
+                prio += 1
+            else:
+                break
+            topic, msg, retain, queued_ticks, depth, callbacks = queue.get()
             try:
                 start_ticks = time.ticks_ms() # Record start time
-                debug.DEBUG(f"in <<< [{len(MQTT._sub_queue)}] processing {topic}:{msg}")
-                MQTT._callbacks[topic](topic, msg)
+                if debug.state:
+                    debug.DEBUG(f"in <<< [{len(queue)}] processing {topic}:{msg}")
+                if not callbacks and debug.state:
+                    debug.DEBUG(f"in <<< no subscriber for {topic}")
+                for cb, cb_prio in callbacks:
+                    cb(topic, msg)
                 end_ticks = time.ticks_ms() # Record end time
                 duration = time.ticks_diff(end_ticks, start_ticks)
-                debug.DEBUG(f"in <<< callback for {topic} took {duration} ms")
-                MQTT.last_callback_log_time = time.ticks_ms() # 記錄 callback log 的時間
+                if debug.state:
+                    debug.DEBUG(f"in <<< callback for {topic} took {duration} ms")
+                wait = time.ticks_diff(start_ticks, queued_ticks)
+                MQTT.metrics.record(topic, len(msg), duration, wait, depth)
+                lane = MQTT.lane_stats[prio]
+                lane[0] += 1
+                lane[1] += wait
+                if wait > lane[2]:
+                    lane[2] = wait
+                MQTT.last_callback_log_time = end_ticks # 記錄 callback log 的時間
 
             except Exception as e:
+                # callback 錯誤不影響連線，記錄後繼續處理
+                MQTT.reconnect_stats['cb_errors'] += 1
                 debug.DEBUG(f"Error processing message for topic {topic}: {str(e)}")
-                machine.reset()
+            if time.ticks_diff(time.ticks_ms(), budget_start) >= MQTT.budget_ms:
+                break
 
     @staticmethod
-    def _safe_callback(topic, msg):
-        MQTT._sub_queue.append( (topic.decode('utf-8'), msg, False) )  # 將參數加入隊列
+    def _safe_callback(topic, msg, retain=False):
+        route = MQTT._routes.get(topic)
+        if route is None:
+            route = MQTT._route(topic)
+        topic, callbacks, prio = route
+        queue = MQTT._lanes[prio]
+        queue.put( (topic, msg, retain, time.ticks_ms(), len(queue) + 1, callbacks) )  # 將參數加入隊列
+        if MQTT._sub_event:
+            MQTT._sub_event.set()
 
     @staticmethod
-    def sub(topic, cb):
+    def _route(topic):
+        # topic 可以是 bytes 或 str，結果存入 _routes 快取
+        topic_b = topic if isinstance(topic, bytes) else topic.encode('utf-8')
         topic_str = topic if isinstance(topic, str) else topic.decode('utf-8')
-        if topic_str not in MQTT._callbacks:
-            try:
-                if not MQTT._callbacks:
-                    MQTT.client.set_callback(MQTT._safe_callback)
-                MQTT.client.subscribe(topic, qos=0)
-                debug.DEBUG(f"Subscribed to topic: {topic_str}")
-            except Exception as e:
-                debug.DEBUG(f"Subscribe error: {str(e)}")
-                machine.reset()
-        MQTT._callbacks[topic_str] = cb
+        callbacks = MQTT._topics.match(topic_str)
+        prio = MQTT.PRIO_NORMAL
+        if callbacks:
+            prio = MQTT.PRIO_LOW
+            for cb, cb_prio in callbacks:
+                if cb_prio < prio:
+                    prio = cb_prio
+        route = (topic_str, callbacks, prio)
+        if len(MQTT._routes) < MQTT.route_cache_size:
+            MQTT._routes[topic_b] = route
+        return route
+
+    @staticmethod
+    def _rebuild_routes():
+        # 訂閱變動時重建快取，沒有萬用字元的 topic 先預先登錄
+        MQTT._routes.clear()
+        for t in MQTT._callbacks:
+            if '+' not in t and '#' not in t:
+                MQTT._route(t)
+
+    @staticmethod
+    def intern(topic):
+        # 發布用 topic 先轉成 bytes 並快取，之後發布不必再 encode
+        if isinstance(topic, bytes):
+            return topic
+        topic_b = MQTT._interned.get(topic)
+        if topic_b is None:
+            topic_b = MQTT._interned[topic] = topic.encode('utf-8')
+        return topic_b
+
+    @staticmethod
+    def sub(topic, cb, qos=0, priority=1):
+        MQTT.sub_many([(topic, cb, qos, priority)])
+
+    @staticmethod
+    def sub_many(subs):
+        # subs: [(topic, cb[, qos[, priority]]), ...]，新的 topic 合併成一個 SUBSCRIBE 封包送出
+        new_topics = []
+        for sub in subs:
+            topic, cb = sub[0], sub[1]
+            qos = sub[2] if len(sub) > 2 else 0
+            priority = sub[3] if len(sub) > 3 else MQTT.PRIO_NORMAL
+            topic_str = topic if isinstance(topic, str) else topic.decode('utf-8')
+            if topic_str not in MQTT._callbacks or MQTT._sub_qos.get(topic_str, 0) != qos:
+                new_topics.append((topic_str, qos))
+            MQTT._sub_qos[topic_str] = qos
+            MQTT._callbacks[topic_str] = cb
+            MQTT._topics.add(topic_str, (cb, priority))
+        MQTT._rebuild_routes()
+        # 離線時只登記，重連後由 _resubscribe 一併訂閱
+        if new_topics and MQTT.connected:
+            uasyncio.create_task(MQTT._subscribe(new_topics))
+
+    @staticmethod
+    async def _subscribe(topics):
+        try:
+            await MQTT.client.subscribe(topics)
+            for t, qos in topics:
+                MQTT._subscribed[t] = qos
+            debug.DEBUG(f"Subscribed to topics: {topics}")
+        except Exception as e:
+            debug.DEBUG(f"Subscribe error: {str(e)}")
+            MQTT.client.close()
+
+    @staticmethod
+    def unsub(topic):
+        # 只移除本地分派，不送出 UNSUBSCRIBE
+        topic_str = topic if isinstance(topic, str) else topic.decode('utf-8')
+        if topic_str in MQTT._callbacks:
+            del MQTT._callbacks[topic_str]
+            MQTT._sub_qos.pop(topic_str, None)
+            MQTT._topics.remove(topic_str)
+            MQTT._rebuild_routes()
 
     @staticmethod
     def set_last_will(topic, msg, retain=True, qos=0):
@@ -79,21 +549,8 @@ class MQTT:
             MQTT.client.set_last_will(topic, msg, retain, qos=0)
         except Exception as e:
             debug.DEBUG(f"Set last will error: {str(e)}")
-            machine.reset()
-
-    async def flush_pub_queue(): pass
 
     @staticmethod
     async def checkMsg():
-        try:
-            MQTT.client.check_msg()
-            await MQTT.process_sub_msg()
-            MQTT.now += 1
-            if MQTT.now > 300: # rough 30 sec, (keepalive/2) / 0.1s interval
-                MQTT.now = 0
-                MQTT.client.ping() # 回報 keep_alive
-                #debug.DEBUG(f"feed...{int(time.ticks_ms()/1000)}")
-
-        except Exception as e:
-            debug.DEBUG(f"MQTT broken: {str(e)}")
-            machine.reset()
\ No newline at end of file
+        # 封包由背景 _run 任務接收並分派，這裡保留給舊程式呼叫
+        await MQTT.process_sub_msg()
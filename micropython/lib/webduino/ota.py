@@ -0,0 +1,251 @@
+import os, json, time, machine, uasyncio, ubinascii, uhashlib
+from webduino.debug import debug
+from webduino.manifest import Manifest
+from webduino.transfer import UploadStream, VerifiedStream, makedirs
+
+
+def exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def rmtree(path):
+    try:
+        entries = list(os.ilistdir(path))
+    except OSError:
+        return
+    for entry in entries:
+        name = path + '/' + entry[0]
+        if entry[1] == 0x4000:
+            rmtree(name)
+        else:
+            os.remove(name)
+    os.rmdir(path)
+
+
+class OTA:
+    """串流 A/B 更新: 新檔案先放到 staging 目錄，全部驗證過才換上去
+
+    host:  ota begin <json [[path, size, sha256], ...]>
+           ota file <index> [window]   之後同 save bin 的 frame 上傳，
+                                       寫入 ota/<path> 並逐段計算 sha256
+           ota commit                  全部驗證後替換並重新開機
+           ota status / ota abort / ota rollback
+    替換前先把狀態寫到 ota.json，斷電後開機會繼續完成替換 (每個檔案都是 rename)
+    舊檔移到 ota.bak/，新版本第一次開機為 trial: 啟動 WDT，Board 連線後持續
+    health_ms 沒有當機才確認 (刪除 ota.bak)，否則下次開機自動還原舊檔
+    """
+    staging = 'ota'
+    backup = 'ota.bak'
+    state_file = 'ota.json'
+    health_ms = 30000
+    wdt_ms = 120000
+    max_trial_boots = 1
+    state = None       # {'state': ..., 'files': [...], 'boots': n}
+    verified = set()   # 本次上傳已驗證的 index
+    wdt = None
+    _booted = False
+    _health_task = None
+
+    @staticmethod
+    def load():
+        if OTA.state is None:
+            try:
+                with open(OTA.state_file, 'r') as f:
+                    OTA.state = json.load(f)
+            except (OSError, ValueError):
+                OTA.state = {'state': 'idle', 'files': [], 'boots': 0}
+        return OTA.state
+
+    @staticmethod
+    def save(state=None):
+        if state:
+            OTA.state['state'] = state
+        with open(OTA.state_file, 'w') as f:
+            json.dump(OTA.state, f)
+
+    @staticmethod
+    def begin(files):
+        # path 不能包含 .. (與 bundle 相同)，否則 staging 與替換時會寫到目錄之外
+        paths = [Manifest.normalize(f[0]) for f in files]
+        for path in paths:
+            if not path or '..' in path.split('/'):
+                raise ValueError('invalid path ' + path)
+        rmtree(OTA.staging)
+        OTA.verified = set()
+        OTA.state = {'state': 'staging', 'boots': 0,
+                     'files': [{'path': path, 'size': f[1], 'sha256': f[2]} for path, f in zip(paths, files)]}
+        OTA.save()
+
+    @staticmethod
+    def startFile(board, dataArgs):
+        # ota file <index> [window]
+        state = OTA.load()
+        if state['state'] != 'staging':
+            board.report('error:ota not started')
+            return False
+        index = int(dataArgs[2])
+        entry = state['files'][index]
+        if not UploadStream.reserve(board, entry['path']):
+            return False
+        window = int(dataArgs[3]) if len(dataArgs) > 3 else UploadStream.window
+        try:
+            stream = OTAStream(board, index, entry, window)
+        except OSError as e:
+            board.report(f'error:Failed to open file: {str(e)}')
+            return False
+        stream.opened()
+
+    @staticmethod
+    def _check(index, entry):
+        # 上傳時沒有驗證過的檔案 (例如中途重開機)，commit 前重新計算 sha256
+        if index in OTA.verified:
+            return True
+        sha = uhashlib.sha256()
+        buf = bytearray(512)
+        mv = memoryview(buf)
+        try:
+            with open(OTA.staging + '/' + entry['path'], 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    sha.update(mv[:n])
+        except OSError:
+            return False
+        return ubinascii.hexlify(sha.digest()).decode() == entry['sha256']
+
+    @staticmethod
+    def commit():
+        # 回傳錯誤訊息，成功時回傳 None
+        state = OTA.load()
+        if state['state'] != 'staging':
+            return 'ota not started'
+        for i, entry in enumerate(state['files']):
+            if not OTA._check(i, entry):
+                return f"{entry['path']} not verified"
+        for entry in state['files']:
+            entry['new'] = not exists(entry['path'])
+        rmtree(OTA.backup)
+        OTA.save('swap')
+        OTA._swap()
+        return None
+
+    @staticmethod
+    def _swap():
+        # 可重複執行: 斷電後開機從 ota.json 繼續
+        for entry in OTA.state['files']:
+            path = entry['path']
+            staged = OTA.staging + '/' + path
+            if not exists(staged):
+                continue
+            if not entry['new'] and exists(path) and not exists(OTA.backup + '/' + path):
+                makedirs(OTA.backup + '/' + path)
+                os.rename(path, OTA.backup + '/' + path)
+            elif exists(path):
+                os.remove(path)
+            makedirs(path)
+            os.rename(staged, path)
+            Manifest.update(path, entry['sha256'])
+        rmtree(OTA.staging)
+        OTA.state['boots'] = 0
+        OTA.save('trial')
+
+    @staticmethod
+    def rollback():
+        # 只有 trial (或替換到一半) 時可以還原，已確認的版本 ota.bak 已刪除，
+        # 還原只會刪掉新增的檔案；回傳錯誤訊息，成功時回傳 None
+        state = OTA.load()
+        if state['state'] not in ('trial', 'swap'):
+            return 'not in trial'
+        for entry in state['files']:
+            path = entry['path']
+            saved = OTA.backup + '/' + path
+            if exists(saved):
+                if exists(path):
+                    os.remove(path)
+                os.rename(saved, path)
+                Manifest.update(path)
+            elif entry.get('new') and exists(path):
+                os.remove(path)
+                Manifest.remove(path)
+        rmtree(OTA.backup)
+        OTA.save('rolledback')
+        return None
+
+    @staticmethod
+    def abort():
+        rmtree(OTA.staging)
+        OTA.verified = set()
+        OTA.load()
+        if OTA.state['state'] == 'staging':
+            OTA.save('idle')
+
+    @staticmethod
+    def boot():
+        # 開機時呼叫 (boot.py 與 Board 都會呼叫，只執行一次)
+        if OTA._booted:
+            return
+        OTA._booted = True
+        state = OTA.load()
+        if state['state'] == 'swap':
+            OTA._swap()
+        if state['state'] != 'trial':
+            return
+        state['boots'] += 1
+        if state['boots'] > OTA.max_trial_boots:
+            debug.print("ota: new version failed health check, rollback")
+            OTA.rollback()
+            machine.reset()
+            return
+        OTA.save()
+        # 新版本若當機或卡住，WDT 會重新開機並在下次開機還原
+        OTA.wdt = machine.WDT(timeout=OTA.wdt_ms)
+
+    @staticmethod
+    def started(mqtt):
+        # Board 連上 MQTT 後呼叫，trial 狀態持續 health_ms 正常運作才確認
+        if OTA.wdt is None or OTA._health_task is not None:
+            return
+        OTA._health_task = uasyncio.create_task(OTA._health(mqtt))
+
+    @staticmethod
+    async def _health(mqtt):
+        start = time.ticks_ms()
+        # WDT 啟動後無法關閉，確認後仍繼續 feed
+        while True:
+            OTA.wdt.feed()
+            if OTA.state['state'] == 'trial' and mqtt.connected and \
+                    time.ticks_diff(time.ticks_ms(), start) >= OTA.health_ms:
+                rmtree(OTA.backup)
+                OTA.save('ok')
+                debug.print("ota: new version confirmed")
+            await uasyncio.sleep_ms(1000)
+
+    @staticmethod
+    def status():
+        state = OTA.load()
+        return {'state': state['state'], 'boots': state['boots'], 'files': len(state['files']),
+                'verified': len(OTA.verified)}
+
+
+class OTAStream(VerifiedStream):
+    """ota file 的上傳，寫入 staging 目錄，sha256 相符才算驗證完成"""
+
+    def __init__(self, board, index, entry, window):
+        VerifiedStream.__init__(self, board, entry['path'], entry['size'], window,
+                                entry['sha256'], OTA.staging + '/' + entry['path'])
+        self.index = index
+
+    def finish(self):
+        try:
+            self.flush()
+            if self.verify() is None:
+                return
+            OTA.verified.add(self.index)
+            self.board.report(f'save success {self.target}')
+        except OSError as e:
+            self.board.report(f'error:Failed to complete file: {str(e)}')
@@ -0,0 +1,76 @@
+class RingQueue:
+    """固定容量的環形佇列，取代 list.pop(0) (O(n)) 的寫法
+
+    policy:
+        DROP_OLDEST 佇列滿時丟掉最舊的資料，保留新資料
+        DROP_NEWEST 佇列滿時丟掉新進來的資料
+    """
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+
+    def __init__(self, size=32, policy=0):
+        self.size = size
+        self.policy = policy
+        self.buf = [None] * size
+        self.head = 0       # 下一筆要讀取的位置
+        self.count = 0
+        self.dropped = 0
+        self.maxDepth = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count == self.size
+
+    def put(self, item):
+        if self.count == self.size:
+            self.dropped += 1
+            if self.policy == RingQueue.DROP_NEWEST:
+                return False
+            # 覆蓋最舊的一筆
+            self.buf[self.head] = None
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+        self.buf[(self.head + self.count) % self.size] = item
+        self.count += 1
+        if self.count > self.maxDepth:
+            self.maxDepth = self.count
+        return True
+
+    def peek(self):
+        if self.count == 0:
+            return None
+        return self.buf[self.head]
+
+    def get(self):
+        if self.count == 0:
+            return None
+        item = self.buf[self.head]
+        self.buf[self.head] = None  # 釋放參照，讓 gc 可以回收
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        return item
+
+    def drop(self, pred):
+        # 丟掉第一筆 pred(item) 為 True 的資料，後面的資料往前移，回傳該筆 (沒有則回傳 None)
+        for i in range(self.count):
+            item = self.buf[(self.head + i) % self.size]
+            if pred(item):
+                for j in range(i, self.count - 1):
+                    self.buf[(self.head + j) % self.size] = self.buf[(self.head + j + 1) % self.size]
+                self.buf[(self.head + self.count - 1) % self.size] = None
+                self.count -= 1
+                self.dropped += 1
+                return item
+        return None
+
+    def clear(self):
+        for i in range(self.size):
+            self.buf[i] = None
+        self.head = 0
+        self.count = 0
+
+    def stats(self):
+        return {'depth': self.count, 'size': self.size,
+                'maxDepth': self.maxDepth, 'dropped': self.dropped}
@@ -0,0 +1,108 @@
+import sys, gc, os, uasyncio
+from webduino.manifest import Manifest
+
+
+class DeviceStatus:
+    """info 指令的資料，避免每次查詢都重新讀檔 / statvfs
+
+    static   版本、main.py / boot.py 第一行、儲存空間總量，main.py / boot.py 被
+             save / delete 時才重新讀取
+    volatile 記憶體、網路、剩餘空間，第一次查詢後由背景任務每 interval 秒取樣
+    last     上次回傳給 host 的內容，info delta 只送出與它不同的欄位
+    """
+    interval = 10
+    watched = ('main.py', 'boot.py')
+    static = None
+    volatile = None
+    last = {}
+    _task = None
+
+    @staticmethod
+    def fileChanged(path):
+        if Manifest.normalize(path) in DeviceStatus.watched:
+            DeviceStatus.static = None
+
+    @staticmethod
+    def _firstLine(path):
+        try:
+            with open(path, 'r') as f:
+                return f.readline().strip()
+        except:
+            return "Not found"
+
+    @staticmethod
+    def _static():
+        if DeviceStatus.static is None:
+            st = os.statvfs('/')
+            DeviceStatus.static = {
+                'micropython': sys.version,
+                'storage_total': round(st[0] * st[2] / 1024, 2),
+                'files': {name: DeviceStatus._firstLine(name) for name in DeviceStatus.watched},
+            }
+        return DeviceStatus.static
+
+    @staticmethod
+    def sample(board):
+        st = os.statvfs('/')
+        free = gc.mem_free()
+        DeviceStatus.volatile = {
+            'network': {
+                'ip': board.wifi.sta.ifconfig()[0],
+                'wifi_signal': board.wifi.sta.status('rssi')
+            },
+            'memory': {
+                'total': round((gc.mem_alloc() + free) / 1024, 2),
+                'free': round(free / 1024, 2),
+                'unit': 'KB'
+            },
+            'storage_free': round(st[0] * st[3] / 1024, 2),
+        }
+
+    @staticmethod
+    async def _sampler(board):
+        while True:
+            await uasyncio.sleep(DeviceStatus.interval)
+            try:
+                DeviceStatus.sample(board)
+            except Exception:
+                pass
+
+    @staticmethod
+    def snapshot(board):
+        # 回傳與原本 info 相同格式的 dict，每次都是新的 dict (不修改 cache 內容)
+        if DeviceStatus.volatile is None:
+            DeviceStatus.sample(board)
+        if DeviceStatus._task is None:
+            DeviceStatus._task = uasyncio.create_task(DeviceStatus._sampler(board))
+        static = DeviceStatus._static()
+        volatile = DeviceStatus.volatile
+        return {
+            'micropython': static['micropython'],
+            'network': volatile['network'],
+            'memory': volatile['memory'],
+            'storage': {
+                'total': static['storage_total'],
+                'free': volatile['storage_free'],
+                'unit': 'KB'
+            },
+            'files': static['files'],
+        }
+
+    @staticmethod
+    def delta(info):
+        # 與上次回傳的內容比較，只留下改變的欄位 (第二層以 key 比較)
+        last = DeviceStatus.last
+        changed = {}
+        for key, value in info.items():
+            old = last.get(key)
+            if isinstance(value, dict) and isinstance(old, dict):
+                diff = {k: v for k, v in value.items() if old.get(k) != v}
+                if diff:
+                    changed[key] = diff
+            elif value != old:
+                changed[key] = value
+        DeviceStatus.last = info
+        return changed
+
+
+Manifest.listeners.append(DeviceStatus.fileChanged)
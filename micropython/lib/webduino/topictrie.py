@@ -0,0 +1,84 @@
+class TopicTrie:
+    """MQTT topic filter trie，支援 + (單層) 與 # (多層) 萬用字元
+
+    每個節點是 [children, value]，children 以 topic 的每一層為 key，
+    比對時間與 topic 的層數成正比，不需逐一比對所有訂閱
+    """
+
+    def __init__(self):
+        self.root = [{}, None]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topicFilter, value):
+        node = self.root
+        for level in topicFilter.split('/'):
+            child = node[0].get(level)
+            if child is None:
+                child = node[0][level] = [{}, None]
+            node = child
+        if node[1] is None:
+            self.count += 1
+        node[1] = value
+
+    def get(self, topicFilter):
+        node = self.root
+        for level in topicFilter.split('/'):
+            node = node[0].get(level)
+            if node is None:
+                return None
+        return node[1]
+
+    def remove(self, topicFilter):
+        path = []
+        node = self.root
+        for level in topicFilter.split('/'):
+            child = node[0].get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if node[1] is None:
+            return False
+        node[1] = None
+        self.count -= 1
+        # 移除沒有子節點也沒有值的節點
+        for parent, level in reversed(path):
+            child = parent[0][level]
+            if child[0] or child[1] is not None:
+                break
+            del parent[0][level]
+        return True
+
+    def match(self, topic):
+        found = []
+        nodes = [self.root]
+        # $ 開頭的系統 topic 不比對第一層萬用字元
+        system = topic.startswith('$')
+        for level in topic.split('/'):
+            nxt = []
+            for node in nodes:
+                children = node[0]
+                if not system or node is not self.root:
+                    child = children.get('#')
+                    if child is not None and child[1] is not None:
+                        found.append(child[1])
+                    child = children.get('+')
+                    if child is not None:
+                        nxt.append(child)
+                child = children.get(level)
+                if child is not None:
+                    nxt.append(child)
+            nodes = nxt
+            if not nodes:
+                return found
+        for node in nodes:
+            if node[1] is not None:
+                found.append(node[1])
+            # "a/#" 也符合 "a"
+            child = node[0].get('#')
+            if child is not None and child[1] is not None:
+                found.append(child[1])
+        return found
@@ -0,0 +1,566 @@
+import os, time, struct, uasyncio, ubinascii, uhashlib
+from webduino.debug import debug
+from webduino.manifest import Manifest
+
+
+class ReadStream:
+    """視窗式串流下載 (board -> host)，取代一次一個區塊再 sleep 的 read
+
+    host:  read <path> stream [chunk] [window]
+    board: read start <id> <size> <chunks> <chunk>
+           read chunk <id> <seq> <base64>    最多 window 個未確認的 chunk
+    host:  read ack <id> <seq>              累積確認 seq (含) 之前的 chunk
+           read resend <id> <seq> [seq...]  只重送遺失的 chunk
+           read cancel <id>
+    board: read done <id> / read error <id> <msg>
+    timeout_ms 內沒有收到 ack 時從最小未確認的 chunk 開始重送 (go-back-N)
+    """
+    CONTROL = ('ack', 'resend', 'cancel')
+    chunk_size = 1024
+    window = 8
+    max_chunk = 4096
+    max_streams = 2
+    timeout_ms = 3000
+    max_retries = 5
+    streams = {}  # id -> ReadStream
+    _next_id = 0
+
+    def __init__(self, board, path, chunk, window):
+        self.board = board
+        self.size = os.stat(path)[6]
+        self.f = open(path, 'rb')
+        self.chunk = chunk
+        self.window = window
+        self.chunks = (self.size + chunk - 1) // chunk
+        self.buf = bytearray(chunk)  # 每個 chunk 共用同一個 buffer
+        self.base = 0      # 最小未確認的 seq
+        self.next = 0      # 下一個第一次送出的 seq
+        self.missing = []  # host 要求重送的 seq
+        self.retries = 0
+        self.cancelled = False
+        self.event = uasyncio.Event()
+        ReadStream._next_id = (ReadStream._next_id + 1) & 0xffff
+        self.id = ReadStream._next_id
+
+    @staticmethod
+    def start(board, dataArgs):
+        # read <path> stream [chunk] [window]
+        path = dataArgs[1]
+        chunk = int(dataArgs[3]) if len(dataArgs) > 3 else ReadStream.chunk_size
+        window = int(dataArgs[4]) if len(dataArgs) > 4 else ReadStream.window
+        if len(ReadStream.streams) >= ReadStream.max_streams:
+            board.report('read error busy')
+            return False
+        if chunk <= 0 or chunk > ReadStream.max_chunk or window <= 0:
+            board.report('read error invalid chunk/window')
+            return False
+        try:
+            stream = ReadStream(board, path, chunk, window)
+        except OSError as e:
+            board.report(f'read error {str(e)}')
+            return False
+        ReadStream.streams[stream.id] = stream
+        uasyncio.create_task(stream.run())
+
+    @staticmethod
+    def control(board, dataArgs):
+        # read ack|resend|cancel <id> ...
+        stream = ReadStream.streams.get(int(dataArgs[2]))
+        if stream is None:
+            board.report(f'read error {dataArgs[2]} unknown stream')
+            return False
+        op = dataArgs[1]
+        if op == 'ack':
+            stream.ack(int(dataArgs[3]))
+        elif op == 'resend':
+            stream.resend([int(s) for s in dataArgs[3:] if s])
+        else:
+            stream.cancelled = True
+            stream.event.set()
+
+    def ack(self, seq):
+        if seq >= self.base:
+            self.base = min(seq + 1, self.chunks)
+            if self.next < self.base:
+                self.next = self.base
+            self.retries = 0
+            self.event.set()
+
+    def resend(self, seqs):
+        for seq in seqs:
+            if self.base <= seq < self.next and seq not in self.missing:
+                self.missing.append(seq)
+        self.event.set()
+
+    async def send(self, seq):
+        self.f.seek(seq * self.chunk)
+        n = self.f.readinto(self.buf)
+        data = ubinascii.b2a_base64(memoryview(self.buf)[:n])
+        await self.board.mqtt.apub(self.board.topic_ack, b'read chunk %d %d ' % (self.id, seq) + data[:-1])
+
+    async def run(self):
+        board = self.board
+        try:
+            board.report(f'read start {self.id} {self.size} {self.chunks} {self.chunk}')
+            while self.base < self.chunks and not self.cancelled:
+                if self.missing:
+                    seq = self.missing.pop(0)
+                    if seq >= self.base:
+                        await self.send(seq)
+                    continue
+                if self.next < self.chunks and self.next - self.base < self.window:
+                    await self.send(self.next)
+                    self.next += 1
+                    continue
+                # window 已滿，等待 ack / resend
+                self.event.clear()
+                try:
+                    await uasyncio.wait_for(self.event.wait(), self.timeout_ms / 1000)
+                except uasyncio.TimeoutError:
+                    self.retries += 1
+                    if self.retries > self.max_retries:
+                        board.report(f'read error {self.id} timeout')
+                        return
+                    debug.print(f"read stream {self.id} timeout, resend from {self.base}")
+                    self.next = self.base
+            if self.cancelled:
+                board.report(f'read error {self.id} cancelled')
+            else:
+                board.report(f'read done {self.id}')
+        except Exception as e:
+            board.report(f'read error {self.id} {str(e)}')
+        finally:
+            self.f.close()
+            ReadStream.streams.pop(self.id, None)
+
+
+def makedirs(path):
+    # 建立檔案路徑中尚不存在的目錄
+    current = ''
+    for part in path.split('/')[:-1]:
+        if part:
+            current += '/' + part if current or path.startswith('/') else part
+            try:
+                os.mkdir(current)
+            except OSError:
+                pass
+
+
+class UploadStream:
+    """二進位分塊上傳 (host -> board)，取代 save <path> data:<seek> <base64>
+
+    host:  save <path> bin <size> [window]        (<devId>-cmd)
+    board: save ready <id> <window> <max_chunk>
+    host:  每個 frame 發布到 <devId>-upload: header + 原始資料
+           header '<HIHI': id, offset, length, crc32 (12 bytes)
+    board: save ack <id> <received>   每 window/2 個 frame 累積確認一次
+           save nak <id> <received>   CRC 錯誤或缺少資料，host 從 received 重送
+           save success <path>
+    host:  save cancel <id>
+    資料先寫入預先配置的 buf_size buffer，滿了才寫入 flash
+    """
+    CONTROL = ('cancel',)
+    HEADER = '<HIHI'
+    HEADER_SIZE = 12
+    buf_size = 4096
+    window = 8
+    max_chunk = 2048
+    max_streams = 2
+    idle_ms = 30000   # 超過此時間沒有資料的傳輸，在開始新傳輸時會被清除
+    streams = {}  # id -> UploadStream
+    _next_id = 0
+
+    def __init__(self, board, path, size, window, target=None):
+        self.target = target or path  # 實際寫入的檔案
+        self.f = self._open()
+        self.board = board
+        self.path = path
+        self.size = size
+        self.window = window
+        self.buf = bytearray(UploadStream.buf_size)
+        self.fill = 0        # buf 中尚未寫入 flash 的 bytes
+        self.received = 0    # 連續收到的 bytes
+        self.unacked = 0
+        self.naked = -1      # 已送出 nak 的位置，避免重複要求
+        self.last = time.ticks_ms()
+        UploadStream._next_id = (UploadStream._next_id + 1) & 0xffff
+        self.id = UploadStream._next_id
+
+    def _open(self):
+        makedirs(self.target)
+        return open(self.target, 'wb')
+
+    @staticmethod
+    def start(board, dataArgs):
+        # save <path> bin <size> [window]
+        if not UploadStream.reserve(board, dataArgs[1]):
+            return False
+        try:
+            size = int(dataArgs[3])
+            window = int(dataArgs[4]) if len(dataArgs) > 4 else UploadStream.window
+            stream = UploadStream(board, dataArgs[1], size, window)
+        except (ValueError, IndexError, OSError) as e:
+            board.report(f'error:Failed to open file: {str(e)}')
+            return False
+        stream.opened()
+
+    @staticmethod
+    def reserve(board, path):
+        # 清除同一個檔案或閒置過久的傳輸，確認還有空位
+        now = time.ticks_ms()
+        for stream in list(UploadStream.streams.values()):
+            if stream.path == path or time.ticks_diff(now, stream.last) > UploadStream.idle_ms:
+                stream.close()
+        if len(UploadStream.streams) >= UploadStream.max_streams:
+            board.report('error:busy save')
+            return False
+        return True
+
+    def opened(self):
+        UploadStream.streams[self.id] = self
+        self.board.report(f'save ready {self.id} {self.window} {UploadStream.max_chunk}')
+        if self.received == self.size:
+            self.finish()
+
+    @staticmethod
+    def control(board, dataArgs):
+        # save cancel <id>
+        stream = UploadStream.streams.get(int(dataArgs[2]))
+        if stream:
+            stream.close()
+        board.report(f'save cancel {dataArgs[2]}')
+
+    @staticmethod
+    def frame(board, data):
+        if len(data) < UploadStream.HEADER_SIZE:
+            return
+        xid, offset, length, crc = struct.unpack_from(UploadStream.HEADER, data)
+        stream = UploadStream.streams.get(xid)
+        if stream is None:
+            board.report(f'save error {xid} unknown transfer')
+            return
+        stream.write(offset, memoryview(data)[UploadStream.HEADER_SIZE:UploadStream.HEADER_SIZE + length], crc)
+
+    def write(self, offset, chunk, crc):
+        self.last = time.ticks_ms()
+        if offset == self.received:
+            if ubinascii.crc32(chunk) != crc or offset + len(chunk) > self.size:
+                self.nak()
+                return
+            try:
+                self.feed(chunk)
+            except (OSError, ValueError) as e:
+                self.board.report(f'error:Failed to write chunk: {str(e)}')
+                self.close()
+                return
+            if self.received == self.size:
+                self.finish()
+                return
+        elif offset > self.received:
+            # 前面的 frame 遺失
+            self.nak()
+            return
+        # 重複的 frame 也計入，host 逾時重送時可以重新取得 ack
+        self.unacked += 1
+        if self.unacked >= max(1, self.window // 2):
+            self.unacked = 0
+            self.board.report(f'save ack {self.id} {self.received}')
+
+    def feed(self, chunk):
+        self.append(chunk)
+        self.received += len(chunk)
+
+    def append(self, chunk):
+        pos = 0
+        n = len(chunk)
+        while pos < n:
+            k = min(n - pos, UploadStream.buf_size - self.fill)
+            self.buf[self.fill:self.fill + k] = chunk[pos:pos + k]
+            self.fill += k
+            pos += k
+            if self.fill == UploadStream.buf_size:
+                self.f.write(self.buf)
+                self.fill = 0
+
+    def nak(self):
+        if self.naked != self.received:
+            self.naked = self.received
+            self.board.report(f'save nak {self.id} {self.received}')
+
+    def flush(self):
+        if self.fill:
+            self.f.write(memoryview(self.buf)[:self.fill])
+            self.fill = 0
+        self.close()
+
+    def finish(self):
+        try:
+            self.flush()
+            actual = os.stat(self.target)[6]
+            if actual != self.size:
+                self.board.report(f'error:Size mismatch. Expected {self.size}, got {actual}')
+                return
+            Manifest.update(self.path)
+            self.board.report(f'save success {self.path}')
+        except OSError as e:
+            self.board.report(f'error:Failed to complete file: {str(e)}')
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+        UploadStream.streams.pop(self.id, None)
+
+
+def fileHashes(path, block=1024):
+    # 每個區塊的 crc32 與整個檔案的 sha256，給 host 計算差異
+    sha = uhashlib.sha256()
+    blocks = []
+    buf = bytearray(block)
+    mv = memoryview(buf)
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            blocks.append(ubinascii.crc32(mv[:n]))
+            sha.update(mv[:n])
+            size += n
+    return {'path': path, 'size': size, 'block': block,
+            'sha256': ubinascii.hexlify(sha.digest()).decode(), 'blocks': blocks}
+
+
+class VerifiedStream(UploadStream):
+    """寫入時同時計算 sha256，完成時與 host 提供的 sha256 (hex) 比對"""
+
+    def __init__(self, board, path, size, window, sha256, target):
+        UploadStream.__init__(self, board, path, size, window, target)
+        self.sha256 = sha256
+        self.hash = uhashlib.sha256()
+
+    def append(self, chunk):
+        self.hash.update(chunk)
+        UploadStream.append(self, chunk)
+
+    def verify(self):
+        # flush 之後呼叫，不符時刪除 target 並回報錯誤，相符時回傳 digest
+        digest = ubinascii.hexlify(self.hash.digest()).decode()
+        if digest != self.sha256:
+            os.remove(self.target)
+            self.board.report(f'error:Hash mismatch. Expected {self.sha256}, got {digest}')
+            return None
+        return digest
+
+
+class DeltaStream(VerifiedStream):
+    """只上傳有變動的區塊 (host 先用 hashes 指令取得舊檔的區塊 crc32)
+
+    host:  save <path> delta <size> <sha256> <block> <ops> [window]
+           ops 依新檔案順序以逗號分隔: c<i>[-<j>] 複製舊檔第 i..j 區塊，
+           l<n> 接下來 n bytes 由 <devId>-upload frame 送來，沒有 ops 時為 -
+    之後的 frame / ack / nak 與 bin 上傳相同，新檔案先寫到 <path>.tmp，
+    sha256 相符才取代原檔
+    """
+
+    def __init__(self, board, path, size, window, sha256, block, ops):
+        self.src = open(path, 'rb')
+        try:
+            VerifiedStream.__init__(self, board, path, size, window, sha256, path + '.tmp')
+            self.block = block
+            self.copybuf = bytearray(block)
+            self.ops = []
+            for op in ops.split(','):
+                if op[:1] == 'c':
+                    r = op[1:].split('-')
+                    self.ops.append(('c', int(r[0]), int(r[-1])))
+                elif op[:1] == 'l':
+                    self.ops.append(('l', int(op[1:]), 0))
+        except:
+            self.discard()
+            raise
+        self.op = 0
+        self.literal = 0  # 目前 literal op 還需要的 bytes
+
+    @staticmethod
+    def start(board, dataArgs):
+        if not UploadStream.reserve(board, dataArgs[1]):
+            return False
+        try:
+            window = int(dataArgs[7]) if len(dataArgs) > 7 else UploadStream.window
+            stream = DeltaStream(board, dataArgs[1], int(dataArgs[3]), window,
+                                 dataArgs[4], int(dataArgs[5]), dataArgs[6])
+        except OSError as e:
+            board.report(f'error:Failed to open file: {str(e)}')
+            return False
+        except (ValueError, IndexError) as e:
+            board.report(f'error:Invalid delta: {str(e)}')
+            return False
+        try:
+            stream.advance()
+        except (ValueError, IndexError, OSError) as e:
+            stream.discard()
+            board.report(f'error:Invalid delta: {str(e)}')
+            return False
+        stream.opened()
+
+    def advance(self):
+        # 執行 copy op，直到需要 host 送資料 (literal) 或全部完成
+        mv = memoryview(self.copybuf)
+        while self.literal == 0 and self.op < len(self.ops):
+            kind, a, b = self.ops[self.op]
+            self.op += 1
+            if kind == 'l':
+                self.literal = a
+                continue
+            for i in range(a, b + 1):
+                self.src.seek(i * self.block)
+                n = self.src.readinto(self.copybuf)
+                if not n or self.received + n > self.size:
+                    raise ValueError('copy out of range')
+                self.append(mv[:n])
+                self.received += n
+
+    def feed(self, chunk):
+        pos = 0
+        while pos < len(chunk):
+            n = min(self.literal, len(chunk) - pos)
+            if n == 0:
+                raise ValueError('unexpected data')
+            self.append(chunk[pos:pos + n])
+            self.received += n
+            self.literal -= n
+            pos += n
+            self.advance()
+
+    def finish(self):
+        try:
+            self.flush()
+            digest = self.verify()
+            if digest is None:
+                return
+            os.remove(self.path)
+            os.rename(self.target, self.path)
+            Manifest.update(self.path, digest)
+            self.board.report(f'save success {self.path}')
+        except OSError as e:
+            self.board.report(f'error:Failed to complete file: {str(e)}')
+
+    def close(self):
+        self.src.close()
+        UploadStream.close(self)
+
+    def discard(self):
+        # 中止傳輸: 關閉舊檔與 .tmp 並刪除 .tmp，建構到一半失敗時也可以呼叫
+        self.src.close()
+        if getattr(self, 'f', None):
+            self.f.close()
+            self.f = None
+        if hasattr(self, 'id'):
+            UploadStream.streams.pop(self.id, None)
+        try:
+            os.remove(self.target)
+        except OSError:
+            pass
+
+
+class BundleStream(UploadStream):
+    """多個檔案打包成一個串流上傳，收到的資料直接解開寫入 flash
+
+    host:  save <dir> bundle <size> [window]
+           之後同 save bin 的 frame 上傳，內容為連續的紀錄:
+           '<HI' pathLen dataLen，path (utf-8，相對於 <dir>)，data
+           pathLen 為 0 的紀錄代表結束
+    board: 傳輸中只有 frame 的 ack / nak，全部寫完回覆一次
+           save success <dir> <檔案數> files
+    需要的目錄自動建立，每個目錄只建立一次
+    """
+    RECORD = '<HI'
+    RECORD_SIZE = 6
+
+    def __init__(self, board, path, size, window):
+        UploadStream.__init__(self, board, path, size, window)
+        self.prefix = '' if path in ('', '/') else path.rstrip('/') + '/'
+        self.hdr = bytearray()
+        self.need = BundleStream.RECORD_SIZE  # 目前紀錄 header + path 的長度
+        self.remain = 0     # 目前檔案尚未收到的 bytes
+        self.name = None
+        self.files = 0
+        self.done = False
+        self.dirs = set()
+
+    def _open(self):
+        return None
+
+    @staticmethod
+    def start(board, dataArgs):
+        # save <dir> bundle <size> [window]
+        if not UploadStream.reserve(board, dataArgs[1]):
+            return False
+        try:
+            window = int(dataArgs[4]) if len(dataArgs) > 4 else UploadStream.window
+            stream = BundleStream(board, dataArgs[1], int(dataArgs[3]), window)
+        except (ValueError, IndexError) as e:
+            board.report(f'error:Invalid bundle: {str(e)}')
+            return False
+        stream.opened()
+
+    def feed(self, chunk):
+        pos = 0
+        n = len(chunk)
+        while pos < n:
+            if self.done:
+                raise ValueError('data after end of bundle')
+            if self.remain:
+                k = min(self.remain, n - pos)
+                self.append(chunk[pos:pos + k])
+                self.remain -= k
+                pos += k
+                if self.remain == 0:
+                    self.endFile()
+                continue
+            k = min(self.need - len(self.hdr), n - pos)
+            self.hdr.extend(chunk[pos:pos + k])
+            pos += k
+            if len(self.hdr) == self.need:
+                self.record()
+        self.received += n
+
+    def record(self):
+        plen, dlen = struct.unpack_from(BundleStream.RECORD, self.hdr)
+        if plen == 0:
+            self.done = True
+            return
+        if len(self.hdr) == BundleStream.RECORD_SIZE:
+            self.need += plen  # 繼續收 path
+            return
+        name = bytes(self.hdr[BundleStream.RECORD_SIZE:]).decode('utf-8').lstrip('/')
+        if '..' in name.split('/'):
+            raise ValueError('invalid path ' + name)
+        self.hdr = bytearray()
+        self.need = BundleStream.RECORD_SIZE
+        self.name = self.prefix + name
+        folder = self.name.rsplit('/', 1)[0] if '/' in self.name else ''
+        if folder not in self.dirs:
+            makedirs(self.name)
+            self.dirs.add(folder)
+        self.f = open(self.name, 'wb')
+        self.remain = dlen
+        if dlen == 0:
+            self.endFile()
+
+    def endFile(self):
+        if self.fill:
+            self.f.write(memoryview(self.buf)[:self.fill])
+            self.fill = 0
+        self.f.close()
+        self.f = None
+        Manifest.update(self.name)
+        self.files += 1
+
+    def finish(self):
+        self.close()
+        if not self.done or self.remain:
+            self.board.report(f'error:Incomplete bundle, {self.files} files written')
+            return
+        self.board.report(f'save success {self.path} {self.files} files')
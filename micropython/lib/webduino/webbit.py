@@ -143,7 +143,7 @@ class WebBit(Board):
         for i in range(25):
             self.rgb.append(RGB(self, i))
 
-    def __init__(self, devId='', mqtt=False,topic_report='waboard/state', topic_report_msg='disconnect',log_level='INFO',state_callback=None):
+    def __init__(self, devId='', mqtt=False,topic_report='waboard/state', topic_report_msg='disconnect',log_level='INFO',state_callback=None,clean_session=True):
         self.current_log_level = log_level  # 預設日誌級別
         self.np = neopixel.NeoPixel(machine.Pin(18), 25)
         self.buzzer = Buzzer()
@@ -164,7 +164,7 @@ class WebBit(Board):
         self._vibration_sensors = {}
         self.wled = {0: 20, 1: 15, 2: 10, 3: 5, 4: 0, 5: 21, 6: 16, 7: 11, 8: 6, 9: 1, 10: 22, 11: 17,
                      12: 12, 13: 7, 14: 2, 15: 23, 16: 18, 17: 13, 18: 8, 19: 3, 20: 24, 21: 19, 22: 14, 23: 9, 24: 4}
-        super().__init__(devId, mqtt, topic_report=topic_report, topic_report_msg=topic_report_msg,state_callback=state_callback)
+        super().__init__(devId, mqtt, topic_report=topic_report, topic_report_msg=topic_report_msg,state_callback=state_callback,clean_session=clean_session)
         self.showAll(0, 0, 0)
         self.beep()
 
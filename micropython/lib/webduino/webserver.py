@@ -50,7 +50,7 @@ class WebServer:
             debug.print("save config:"+config)
             self.board.config.updateFromString(config)
             self.board.config.save()
-            cs.send(b"完成儲存，開發板將自動連上wifi")
+            cs.send("完成儲存，開發板將自動連上wifi".encode("utf-8"))
             cs.close()
             debug.print("Restart...")
             time.sleep(3)
@@ -0,0 +1,277 @@
+"""把電腦上的檔案部署到開發板，只傳送有變動的區塊
+
+    python3 wasync.py <devId> <local> [remote] [-s server] [-p port]
+    python3 wasync.py <devId> --ota <local>[:<remote>] ... [-s server] [-p port]
+    python3 wasync.py <devId> --bundle <dir> <local>[:<remote>] ... [-s server] [-p port]
+
+流程:
+    1. hashes <remote> 取得開發板上舊檔每個區塊的 crc32
+    2. 在新檔案中尋找相同內容的區塊 (任意位置)，其餘部分當作 literal
+    3. save <remote> delta ... 只送出 literal 資料，開發板從舊檔複製其他區塊，
+       最後比對 sha256
+開發板上沒有舊檔、或 delta 失敗時改用 save <remote> bin 整個檔案上傳
+
+--ota 把多個檔案以 OTA 方式部署: 先全部上傳到開發板的 staging 目錄並驗證
+sha256，ota commit 後一次替換並重新開機，新版本無法正常執行時開發板自動還原
+
+--bundle 把多個小檔案打包成一個串流 (save <dir> bundle)，開發板邊收邊解開，
+不需要每個檔案各自 size / data / complete
+"""
+import sys, time, json, struct, binascii, hashlib
+
+_here = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+sys.path.insert(0, _here + '/../bench')
+import compat
+import uasyncio
+from webduino.amqtt import AsyncMQTTClient
+
+HEADER = '<HIHI'
+CHUNK = 1024
+BLOCK = 1024
+MAX_RETRIES = 3   # 連續逾時幾次就放棄 (開發板重開機 / 離線 / 傳輸已被清除)
+
+
+def delta(data, blocks, block, size):
+    # 回傳 (ops 字串, [(offset, bytes), ...] literal 資料)
+    # blocks / size 為開發板舊檔每個區塊的 crc32 與檔案大小
+    last = len(blocks) - 1
+    lastLen = size - last * block  # 最後一個區塊可能不足 block
+    index = {}
+    for i, h in enumerate(blocks):
+        if i < last or lastLen == block:
+            index.setdefault(h, i)
+    ops = []
+    literals = []
+    start = 0     # 尚未送出的 literal 起點
+    pos = 0
+
+    def literal(end):
+        if end > start:
+            ops.append('l%d' % (end - start))
+            literals.append((start, data[start:end]))
+
+    def copy(i):
+        if ops and ops[-1][0] == 'c':
+            r = ops[-1][1:].split('-')
+            if int(r[-1]) + 1 == i:
+                ops[-1] = 'c%s-%d' % (r[0], i)
+                return
+        ops.append('c%d' % i)
+
+    while pos + block <= len(data):
+        i = index.get(binascii.crc32(data[pos:pos + block]))
+        if i is None:
+            pos += 1
+            continue
+        literal(pos)
+        copy(i)
+        pos += block
+        start = pos
+    # 不足 block 的最後一個區塊只能對應新檔結尾
+    end = len(data) - lastLen
+    if blocks and lastLen < block and end >= start and binascii.crc32(data[end:]) == blocks[last]:
+        literal(end)
+        copy(last)
+        start = len(data)
+    literal(len(data))
+    return ','.join(ops) or '-', literals
+
+
+class BoardLink:
+
+    def __init__(self, devId, server='mqtt1.webduino.io', port=1883):
+        self.devId = devId
+        self.client = AsyncMQTTClient('wasync%d' % (time.ticks_ms() % 100000), server, port)
+        self.replies = []
+        self.event = uasyncio.Event()
+
+    async def open(self):
+        self.client.set_callback(self.on_reply)
+        await self.client.connect()
+        self.task = uasyncio.create_task(self.client.run())
+        await self.client.subscribe(['waboard/%s/ack' % self.devId])
+
+    async def close(self):
+        await self.client.disconnect()
+        try:
+            await self.task
+        except Exception:
+            pass
+
+    def on_reply(self, topic, msg, retain):
+        self.replies.append(msg.decode('utf-8'))
+        self.event.set()
+
+    async def cmd(self, text):
+        await self.client.publish(self.devId + '-cmd', text.encode('utf-8'), qos=1)
+
+    async def reply(self, prefixes, timeout=10):
+        # 等待以 prefixes 其中之一開頭的回覆
+        deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        while True:
+            for i, msg in enumerate(self.replies):
+                if msg.startswith(prefixes):
+                    del self.replies[i]
+                    return msg
+            remain = time.ticks_diff(deadline, time.ticks_ms())
+            if remain <= 0:
+                raise OSError('timeout waiting for ' + str(prefixes))
+            self.event.clear()
+            try:
+                await uasyncio.wait_for(self.event.wait(), remain / 1000)
+            except uasyncio.TimeoutError:
+                pass
+
+    async def hashes(self, remote, block=BLOCK):
+        await self.cmd('hashes %s %d' % (remote, block))
+        msg = await self.reply(('hashes ',))
+        if msg.startswith('hashes error'):
+            return None
+        return json.loads(msg[7:])
+
+    async def upload(self, start, literals):
+        # start: save 指令，literals: [(offset, bytes)]，offset 為新檔案中的位置
+        await self.cmd(start)
+        msg = await self.reply(('save ready', 'error'))
+        if msg.startswith('error'):
+            raise OSError(msg)
+        xid, window, max_chunk = [int(v) for v in msg.split(' ')[2:5]]
+        size = min(CHUNK, max_chunk)
+        frames = []
+        for offset, data in literals:
+            for i in range(0, len(data), size):
+                frames.append((offset + i, data[i:i + size]))
+        topic = self.devId + '-upload'
+        acked = 0   # 已確認的 frame 數
+        sent = 0
+        retries = 0
+        while True:
+            while sent < len(frames) and sent - acked < window:
+                pos, chunk = frames[sent]
+                await self.client.publish(topic, struct.pack(HEADER, xid, pos, len(chunk), binascii.crc32(chunk)) + chunk)
+                sent += 1
+            try:
+                msg = await self.reply(('save ack', 'save nak', 'save success', 'error'), 5)
+            except OSError:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise OSError('no reply from board after %d retries' % MAX_RETRIES)
+                sent = acked  # 逾時，從最後確認的位置重送
+                continue
+            retries = 0
+            if msg.startswith('save success'):
+                return True
+            if msg.startswith('error'):
+                raise OSError(msg)
+            pos = int(msg.split(' ')[3])
+            while acked < len(frames) and frames[acked][0] < pos:
+                acked += 1
+            if msg.startswith('save nak'):
+                sent = acked
+
+
+async def sync(link, local, remote):
+    with open(local, 'rb') as f:
+        data = f.read()
+    sha = hashlib.sha256(data).hexdigest()
+    old = await link.hashes(remote)
+    if old and old['sha256'] == sha:
+        return 'unchanged', 0
+    if old:
+        ops, literals = delta(data, old['blocks'], old['block'], old['size'])
+        try:
+            await link.upload('save %s delta %d %s %d %s' % (remote, len(data), sha, old['block'], ops), literals)
+            return 'delta', sum(len(d) for o, d in literals)
+        except OSError as e:
+            print('delta failed, full upload:', e)
+    await link.upload('save %s bin %d' % (remote, len(data)), [(0, data)])
+    return 'full', len(data)
+
+
+async def ota(link, pairs):
+    # pairs: [(local, remote), ...]
+    files = []
+    datas = []
+    for local, remote in pairs:
+        with open(local, 'rb') as f:
+            data = f.read()
+        files.append([remote, len(data), hashlib.sha256(data).hexdigest()])
+        datas.append(data)
+    await link.cmd('ota begin ' + json.dumps(files))
+    msg = await link.reply(('ota begin', 'ota error'))
+    if msg.startswith('ota error'):
+        raise OSError(msg)
+    for i, data in enumerate(datas):
+        await link.upload('ota file %d' % i, [(0, data)])
+    await link.cmd('ota commit')
+    msg = await link.reply(('ota commit', 'ota error'), 30)
+    if msg.startswith('ota error'):
+        raise OSError(msg)
+    return 'ota', sum(len(d) for d in datas)
+
+
+def pack(pairs):
+    # 紀錄: '<HI' pathLen dataLen, path, data，最後以 pathLen 0 結束
+    out = bytearray()
+    for local, remote in pairs:
+        with open(local, 'rb') as f:
+            data = f.read()
+        name = remote.encode('utf-8')
+        out += struct.pack('<HI', len(name), len(data)) + name + data
+    out += struct.pack('<HI', 0, 0)
+    return bytes(out)
+
+
+async def bundle(link, folder, pairs):
+    data = pack(pairs)
+    await link.upload('save %s bundle %d' % (folder, len(data)), [(0, data)])
+    return 'bundle', len(data)
+
+
+def file_pairs(args):
+    pairs = []
+    for arg in args:
+        local, _, remote = arg.partition(':')
+        pairs.append((local, remote or local.rsplit('/', 1)[-1]))
+    return pairs
+
+
+async def main(args):
+    server = 'mqtt1.webduino.io'
+    port = 1883
+    if '-s' in args:
+        i = args.index('-s')
+        server = args.pop(i + 1)
+        args.pop(i)
+    if '-p' in args:
+        i = args.index('-p')
+        port = int(args.pop(i + 1))
+        args.pop(i)
+    devId = args[0]
+    link = BoardLink(devId, server, port)
+    await link.open()
+    start = time.ticks_ms()
+    try:
+        if args[1] == '--ota':
+            pairs = file_pairs(args[2:])
+            mode, sent = await ota(link, pairs)
+            target = '%d files' % len(pairs)
+        elif args[1] == '--bundle':
+            pairs = file_pairs(args[3:])
+            mode, sent = await bundle(link, args[2], pairs)
+            target = '%d files -> %s' % (len(pairs), args[2])
+        else:
+            local = args[1]
+            remote = args[2] if len(args) > 2 else local.rsplit('/', 1)[-1]
+            mode, sent = await sync(link, local, remote)
+            target = '%s %s' % (local, remote)
+    finally:
+        await link.close()
+    print('%s: %s, %d bytes sent, %d ms' % (target, mode, sent, time.ticks_diff(time.ticks_ms(), start)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    uasyncio.run(main(sys.argv[1:]))